@@ -1,45 +1,194 @@
+import time
+_import_started = time.perf_counter()
+
 import json
-import boto3
-import uuid
+import math
 import os
+import re
+from functools import lru_cache
+import clients
+import metrics
+
+# Batched requests: most utterances handled per call (keep maxItems in
+# frontend/swagger/swagger.yaml in step), and the time each one may take
+# before we give up on it
+MAX_BATCH_MESSAGES = int(os.environ.get('MAX_BATCH_MESSAGES', '10'))
+UTTERANCE_TIMEOUT = float(os.environ.get('UTTERANCE_TIMEOUT', '5'))  # seconds
+# Kept back from the Lambda's own timeout to return the replies
+RESPONSE_MARGIN_MS = int(os.environ.get('RESPONSE_MARGIN_MS', '300'))
+# Messages after the first are only sent to Lex with at least this long left
+MIN_UTTERANCE_TIMEOUT = 0.5  # seconds
+# Extra Lex attempts for throttling and other errors that fail fast
+LEX_RETRIES = int(os.environ.get('LEX_RETRIES', '1'))
+RETRYABLE_ERRORS = {'ThrottlingException', 'InternalServerException', 'BadGatewayException',
+                    'EndpointConnectionError', 'ConnectionClosedError'}
+
+# The Lex V2 clients are built on the first utterance that needs them, so
+# replies from the local fast path never load boto3. One client per read
+# timeout, rounded down to a quarter second so only a few are ever built.
+def lex_client(read_timeout=UTTERANCE_TIMEOUT):
+    read_timeout = max(0.25, math.floor(read_timeout * 4) / 4)
+    return clients.client('lexv2-runtime', connect_timeout=min(2, read_timeout), read_timeout=read_timeout,
+                          retries={'total_max_attempts': 1})
+
+def error_code(e):
+    return ((getattr(e, 'response', None) or {}).get('Error') or {}).get('Code') or type(e).__name__
+
+def recognize_text(deadline, **request):
+    # botocore's retries don't know how long the Lambda has left, so quick
+    # failures are retried here, and only while another attempt still fits
+    for attempt in range(LEX_RETRIES + 1):
+        try:
+            return lex_client(min(UTTERANCE_TIMEOUT, deadline - time.time())).recognize_text(**request)
+        except Exception as e:
+            backoff = 0.1 * 2 ** attempt
+            if attempt == LEX_RETRIES or error_code(e) not in RETRYABLE_ERRORS or deadline - time.time() - backoff < MIN_UTTERANCE_TIMEOUT:
+                raise
+            print(f"Retrying Lex after {error_code(e)}")
+            time.sleep(backoff)
+
+# LOCAL FAST PATH
+# Utterances whose answer never depends on the user or the dialog are answered
+# here without the Lex round trip. The replies match LF1's. Greetings still go
+# to Lex because LF1 personalizes them from the user's history.
+LOCAL_INTENTS_ENABLED = os.environ.get('LOCAL_INTENTS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
 
-# Initialize the Lex V2 client
-lex_client = boto3.client('lexv2-runtime')
+LOCAL_INTENTS = [
+    ('ThankYouIntent', re.compile(r"^(thanks?( you)?( so much| a lot| very much)?|thx|ty|thank u|cheers)$")),
+]
+
+# Intent -> reply, the same strings LF1 closes these intents with
+LOCAL_RESPONSES = {
+    'ThankYouIntent': "You're welcome!"
+}
+
+PUNCTUATION = re.compile(r"[^\w\s']")
+SPACES = re.compile(r"\s+")
+
+# Per-container counters, logged with every request
+stats = {'requests': 0, 'local': 0, 'lex': 0}
+
+# Chat traffic repeats the same few phrases, so remember each verdict
+@lru_cache(maxsize=1024)
+def classify_locally(text):
+    normalized = SPACES.sub(' ', PUNCTUATION.sub(' ', text.lower())).strip()
+    for intent, pattern in LOCAL_INTENTS:
+        if pattern.match(normalized):
+            return intent
+    return None
+
+def log_stats(route):
+    stats['requests'] += 1
+    stats[route] += 1
+    metrics.count('LocalReplies' if route == 'local' else 'LexReplies')
+    print(json.dumps({
+        'route': route,
+        'requests': stats['requests'],
+        'local': stats['local'],
+        'lex': stats['lex'],
+        'local_share': round(stats['local'] / stats['requests'], 3)
+    }))
+
+def reply_to(text, user_email, correlation_id, bot_id, bot_alias_id, locale_id, deadline):
+    local_intent = classify_locally(text) if LOCAL_INTENTS_ENABLED else None
+    if local_intent:
+        log_stats('local')
+        return LOCAL_RESPONSES[local_intent]
+
+    # Send to the Lex chatbot and wait for the response
+    try:
+        lex_response = recognize_text(
+            deadline,
+            botId=bot_id,
+            botAliasId=bot_alias_id,
+            localeId=locale_id,
+            sessionId=user_email.replace('@', '-'),
+            text=text,
+            sessionState={
+                'sessionAttributes': {
+                    'email': user_email,
+                    # LF1 copies this into the SQS message for LF2
+                    'correlationId': correlation_id
+                }
+            }
+        )
+    except Exception as e:
+        print("Error calling Lex:", e)
+        raise e
+    log_stats('lex')
+    
+    # Extract the bot's reply from the Lex response object
+    bot_reply = "I didn't quite catch that."
+    if 'messages' in lex_response and len(lex_response['messages']) > 0:
+        bot_reply = lex_response['messages'][0]['content']
+    return bot_reply
 
 def lambda_handler(event, context):
+    # One ID follows this request through Lex, LF1, SQS and LF2
+    correlation_id = (event.get('headers') or {}).get('X-Correlation-Id') or metrics.new_correlation_id()
+    try:
+        with metrics.timer('Handler'):
+            response = handle_request(event, context, correlation_id)
+        response.setdefault('headers', {})['X-Correlation-Id'] = correlation_id
+        return response
+    finally:
+        metrics.flush('LF0', correlation_id)
+
+def handle_request(event, context, correlation_id):
     BOT_ID = os.environ['LEX_BOT_ID']
     BOT_ALIAS_ID = os.environ['LEX_BOT_ALIAS_ID']
     LOCALE_ID = os.environ.get('LEX_LOCALE_ID', 'en_US')
     
     try:
-        # {"messages": [{"unstructured": {"text": "hello"}}]}
+        # {"messages": [{"unstructured": {"text": "hello"}}, ...]}
         body = json.loads(event.get('body', '{}'))
-        user_message = body['messages'][0]['unstructured']['text']
+        user_messages = body['messages']
+        if not user_messages:
+            raise ValueError("No messages in request")
+        if len(user_messages) > MAX_BATCH_MESSAGES:
+            return {
+                'statusCode': 400,
+                'headers': {
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({
+                    'code': 400,
+                    'message': f"At most {MAX_BATCH_MESSAGES} messages can be sent in one request, got {len(user_messages)}."
+                })
+            }
         
         user_email = body.get('userEmail', 'sss10093@nyu.edu')
 
-        # Send to the Lex chatbot and wait for the response
-        try:
-            lex_response = lex_client.recognize_text(
-                botId=BOT_ID,
-                botAliasId=BOT_ALIAS_ID,
-                localeId=LOCALE_ID,
-                sessionId=user_email.replace('@', '-'),
-                text=user_message,
-                sessionState={
-                    'sessionAttributes': {
-                        'email': user_email
-                    }
-                }
-            )
-        except Exception as e:
-            print("Error calling Lex:", e)
-            raise e
-        
-        # Extract the bot's reply from the Lex response object
-        bot_reply = "I didn't quite catch that."
-        if 'messages' in lex_response and len(lex_response['messages']) > 0:
-            bot_reply = lex_response['messages'][0]['content']
+        # Leave room to answer within the Lambda's own timeout
+        deadline = float('inf')
+        if context:
+            deadline = time.time() + (context.get_remaining_time_in_millis() - RESPONSE_MARGIN_MS) / 1000
+
+        # Utterances go to Lex one after another, in the order they were typed
+        replies = []
+        failures = 0
+        for i, user_message in enumerate(user_messages):
+            unstructured = user_message['unstructured']
+
+            # The first message is always tried, with whatever time there is
+            if i > 0 and deadline - time.time() < MIN_UTTERANCE_TIMEOUT:
+                bot_reply = "Sorry, I ran out of time for that one. Could you send it again?"
+                failures += 1
+            else:
+                try:
+                    bot_reply = reply_to(unstructured['text'], user_email, correlation_id, BOT_ID, BOT_ALIAS_ID, LOCALE_ID, deadline)
+                except Exception:
+                    bot_reply = "Sorry, something went wrong with that message. Could you try again?"
+                    failures += 1
+
+            reply = {'text': bot_reply}
+            # Lets the client match each reply to what it sent
+            if unstructured.get('id'):
+                reply['id'] = unstructured['id']
+            replies.append({'type': 'unstructured', 'unstructured': reply})
+
+        if failures == len(user_messages):
+            raise Exception("Every message in the request failed")
             
         # Send back the response from Lex as the API response
         return {
@@ -48,14 +197,7 @@ def lambda_handler(event, context):
                 'Access-Control-Allow-Origin': '*'
             },
             'body': json.dumps({
-                'messages': [
-                    {
-                        'type': 'unstructured',
-                        'unstructured': {
-                            'text': bot_reply
-                        }
-                    }
-                ]
+                'messages': replies
             })
         }
         
@@ -64,4 +206,6 @@ def lambda_handler(event, context):
         return {
             'statusCode': 500,
             'body': json.dumps('Something went wrong with the chatbot API.')
-        }
\ No newline at end of file
+        }
+
+metrics.init_done(_import_started)
@@ -1,24 +1,255 @@
+import time
+_import_started = time.perf_counter()
+
 import json
-import boto3
 import datetime
+import hashlib
 import os
+import re
+from functools import lru_cache
+import clients
+import gazetteer
+import metrics
 
-sqs = boto3.client('sqs')
-QUEUE_URL = os.environ['SQS_QUEUE_URL']
+QUEUE_URL = os.environ.get('SQS_QUEUE_URL')
 HISTORY_TABLE = os.environ.get('DYNAMODB_HISTORY_TABLE', 'UserHistory')
+HISTORY_CACHE_TTL = int(os.environ.get('HISTORY_CACHE_TTL', '300'))  # seconds
+# Most recent distinct cuisines kept in each UserHistory item
+HISTORY_RECENT_SEARCHES = int(os.environ.get('HISTORY_RECENT_SEARCHES', '5'))
+# Lex retries and double submits send the same request more than once. A FIFO
+# queue drops repeats by MessageDeduplicationId; for a standard queue, set a
+# table (partition key RequestKey, TTL on ExpiresAt) to drop them here.
+REQUEST_DEDUPE_TABLE = os.environ.get('REQUEST_DEDUPE_TABLE', '')
+REQUEST_DEDUPE_TTL = int(os.environ.get('REQUEST_DEDUPE_TTL', '600'))  # seconds
+
+# Clients are built on first use and then kept for the life of the container
+def sqs():
+    return clients.client('sqs')
+
+def history_table():
+    return clients.resource('dynamodb').Table(HISTORY_TABLE)
+
+def dedupe_table():
+    return clients.resource('dynamodb').Table(REQUEST_DEDUPE_TABLE)
+
+# Email -> (expires_at, history item or None)
+history_cache = {}
+
+# Optional Neighborhood slot: a place from the gazetteer (a neighborhood, or a
+# city it has a point for), a zip code or "lat, lon". LF2 recommends the
+# closest restaurants to it.
+ZIP_CODE = re.compile(r"^\d{5}$")
+LAT_LON = re.compile(r"^(-?\d{1,2}(?:\.\d+)?)\s*,\s*(-?\d{1,3}(?:\.\d+)?)$")
+
+# USER HISTORY
+# One item per user: LastCuisine, LastLocation and RecentSearches, a list of
+# up to HISTORY_RECENT_SEARCHES {Cuisine, Location, SearchedAt}, newest first.
+# HistoryVersion goes up by one with every write.
+HISTORY_WRITE_ATTEMPTS = 3
+
+def get_history(event, email):
+    # Already read earlier in this conversation
+    session_attributes = event['sessionState'].get('sessionAttributes') or {}
+    if session_attributes.get('historyEmail') == email and session_attributes.get('lastCuisine'):
+        return {
+            'Email': email,
+            'LastCuisine': session_attributes['lastCuisine'],
+            'LastLocation': session_attributes.get('lastLocation'),
+            'RecentSearches': json.loads(session_attributes.get('recentSearches') or '[]'),
+            'HistoryVersion': int(session_attributes.get('historyVersion') or 0)
+        }
+
+    cached = history_cache.get(email)
+    if cached and cached[0] > time.time():
+        return cached[1]
+    return read_history(email)
+
+def read_history(email, consistent=False):
+    # Only the attributes we use, eventually consistent for half the read cost
+    # unless we have to see the latest write
+    response = history_table().get_item(
+        Key={'Email': email},
+        ProjectionExpression='Email, LastCuisine, LastLocation, RecentSearches, HistoryVersion',
+        ConsistentRead=consistent
+    )
+    item = history_item(response.get('Item'))
+    history_cache[email] = (time.time() + HISTORY_CACHE_TTL, item)
+    return item
+
+def history_item(item):
+    if item:
+        item['RecentSearches'] = [
+            {'Cuisine': search.get('Cuisine'), 'Location': search.get('Location'), 'SearchedAt': int(search.get('SearchedAt', 0))}
+            for search in item.get('RecentSearches', [])
+        ]
+        item['HistoryVersion'] = int(item.get('HistoryVersion', 0))
+    return item
+
+def remember_history(event, item):
+    # Keep the history in the Lex session and this container's cache
+    history_cache[item['Email']] = (time.time() + HISTORY_CACHE_TTL, item)
+    session_attributes = event['sessionState'].setdefault('sessionAttributes', {})
+    session_attributes['historyEmail'] = item['Email']
+    session_attributes['lastCuisine'] = item['LastCuisine']
+    session_attributes['lastLocation'] = item['LastLocation']
+    session_attributes['recentSearches'] = json.dumps(item.get('RecentSearches', []))
+    session_attributes['historyVersion'] = str(item.get('HistoryVersion', 0))
+
+def save_history(event, email, cuisine, location):
+    # Returns False when the table already had this search and nothing was
+    # written. The session and cache only seed the merge: the write is always
+    # sent, and only succeeds if the table still has the version it was merged
+    # into and doesn't already hold this search, so neither a stale session nor
+    # two sessions saving at once can lose a search.
+    current = get_history(event, email)
+    table = history_table()
+    for attempt in range(HISTORY_WRITE_ATTEMPTS):
+        recent = [{'Cuisine': cuisine, 'Location': location, 'SearchedAt': int(time.time())}]
+        recent += [search for search in (current or {}).get('RecentSearches', []) if search['Cuisine'] != cuisine]
+        item = {'Email': email, 'LastCuisine': cuisine, 'LastLocation': location, 'RecentSearches': recent[:HISTORY_RECENT_SEARCHES]}
+
+        version = (current or {}).get('HistoryVersion', 0)
+        values = {':cuisine': cuisine, ':location': location, ':recent': item['RecentSearches'], ':one': 1}
+        if version:
+            values[':version'] = version
+        try:
+            response = table.update_item(
+                Key={'Email': email},
+                UpdateExpression='SET LastCuisine = :cuisine, LastLocation = :location, RecentSearches = :recent ADD HistoryVersion :one',
+                # Items from before HistoryVersion have none, like new ones
+                ConditionExpression=('HistoryVersion = :version' if version else 'attribute_not_exists(HistoryVersion)') +
+                    ' AND (attribute_not_exists(LastCuisine) OR LastCuisine <> :cuisine OR LastLocation <> :location)',
+                ExpressionAttributeValues=values,
+                ReturnValues='UPDATED_NEW',
+                ReturnValuesOnConditionCheckFailure='ALL_OLD'
+            )
+        except table.meta.client.exceptions.ConditionalCheckFailedException as e:
+            current = stored_history(email, e)
+            if current and current['LastCuisine'] == cuisine and current['LastLocation'] == location:
+                # Already the last search
+                remember_history(event, current)
+                return False
+            # Saved by another session since we read it, merge into that
+            continue
+        item['HistoryVersion'] = int(response['Attributes']['HistoryVersion'])
+        remember_history(event, item)
+        return True
+
+    print(f"Couldn't save history for {email} after {HISTORY_WRITE_ATTEMPTS} attempts")
+    return False
+
+def stored_history(email, error):
+    # The item a conditional write failed on, sent back with the error
+    if 'Item' not in error.response:
+        return read_history(email, consistent=True)
+    from boto3.dynamodb.types import TypeDeserializer
+    deserializer = TypeDeserializer()
+    item = history_item({name: deserializer.deserialize(value) for name, value in error.response['Item'].items()})
+    history_cache[email] = (time.time() + HISTORY_CACHE_TTL, item)
+    return item
+
+# SENDING REQUESTS TO LF2
+def request_key(sqs_message):
+    # The same user asking for the same table gets the same key
+    fields = [sqs_message.get(name) for name in ('Email', 'Cuisine', 'DiningDate', 'DiningTime', 'NumberOfPeople', 'Area')]
+    normalized = '|'.join(str(value).strip().lower() if value is not None else '' for value in fields)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+def claim_request(key):
+    # False if the same request was already sent within REQUEST_DEDUPE_TTL
+    now = int(time.time())
+    table = dedupe_table()
+    try:
+        table.put_item(
+            Item={'RequestKey': key, 'ExpiresAt': now + REQUEST_DEDUPE_TTL},
+            # DynamoDB's TTL deletes lazily, so an expired item still counts as gone
+            ConditionExpression='attribute_not_exists(RequestKey) OR ExpiresAt < :now',
+            ExpressionAttributeValues={':now': now}
+        )
+        return True
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+
+def send_request(sqs_message):
+    key = request_key(sqs_message)
+    sqs_message['RequestKey'] = key
+    params = {'QueueUrl': QUEUE_URL, 'MessageBody': json.dumps(sqs_message)}
+
+    if QUEUE_URL and QUEUE_URL.endswith('.fifo'):
+        # SQS drops a repeat of the same ID within five minutes
+        params.update(MessageGroupId=str(sqs_message.get('Email')), MessageDeduplicationId=key)
+    elif REQUEST_DEDUPE_TABLE:
+        if not claim_request(key):
+            print(f"Request {key} was already sent, not sending it again")
+            metrics.count('DuplicateRequests')
+            return False
+        try:
+            sqs().send_message(**params)
+        except Exception:
+            # Let a retry through, nothing reached the queue
+            dedupe_table().delete_item(Key={'RequestKey': key})
+            raise
+        return True
+
+    sqs().send_message(**params)
+    return True
+
+# AREA
+def resolve_area(text):
+    # The fields LF2 needs to rank by distance, or None if we can't place it
+    text = text.strip().lower()
+    if ZIP_CODE.match(text):
+        # LF2 places zip codes from the restaurants it knows in them
+        return {'ZipCode': text}
+    match = LAT_LON.match(text)
+    if match:
+        lat, lon = float(match.group(1)), float(match.group(2))
+        if -90 <= lat <= 90 and -180 <= lon <= 180:
+            return {'Latitude': lat, 'Longitude': lon}
+    point = gazetteer.location_point(gazetteer.match_location(text))
+    if point:
+        return {'Latitude': point[0], 'Longitude': point[1]}
+    return None
+
+def slot_value(slots, name):
+    return ((slots.get(name) or {}).get('value') or {}).get('interpretedValue')
+
+@lru_cache(maxsize=32)
+def zone(timezone_name):
+    try:
+        from zoneinfo import ZoneInfo
+        return ZoneInfo(timezone_name)
+    except Exception as e:
+        # No tz database in the runtime, fall back to New York standard time
+        print(f"Unknown timezone {timezone_name}: {e}")
+        return datetime.timezone(datetime.timedelta(hours=-5))
+
+@lru_cache(maxsize=64)
+def _minute_now(timezone_name, minute):
+    return datetime.datetime.fromtimestamp(minute * 60, zone(timezone_name))
+
+def local_now(slots):
+    # Wall clock where the user wants to eat, recomputed at most once a minute
+    location = gazetteer.match_location(slot_value(slots, 'Location') or '')
+    return _minute_now(gazetteer.location_timezone(location), int(time.time() // 60))
 
 # VALIDATION LOGIC
 def validate_slots(slots):
     # Validate Cuisine
-    if slots.get('Cuisine') and slots['Cuisine'].get('value'):
-        cuisine = slots['Cuisine']['value'].get('interpretedValue', '').lower()
-        valid_cuisines = ['indian', 'italian', 'japanese', 'mexican', 'chinese', 'thai']
-        if cuisine not in valid_cuisines:
+    cuisine = slot_value(slots, 'Cuisine')
+    if cuisine and gazetteer.match_cuisine(cuisine) is None:
+        similar = gazetteer.similar_cuisines(cuisine)
+        if similar:
             return {
                 'isValid': False,
                 'violatedSlot': 'Cuisine',
-                'message': f"Sorry, we only support {', '.join(valid_cuisines)}. Which of those would you like?"
+                'message': f"Did you mean {' or '.join(similar[:4])}?"
             }
+        return {
+            'isValid': False,
+            'violatedSlot': 'Cuisine',
+            'message': f"Sorry, I don't know any {cuisine} restaurants. Popular choices are {', '.join(gazetteer.popular_cuisines(8))}. Which would you like?"
+        }
 
     # Validate Number of People
     if slots.get('NumberOfPeople') and slots['NumberOfPeople'].get('value'):
@@ -38,17 +269,22 @@ def validate_slots(slots):
             }
             
     # Validate Location
-    if slots.get('Location') and slots['Location'].get('value'):
-        location = slots['Location']['value'].get('interpretedValue', '').lower()
-        # Acceptable variations of NYC
-        valid_locations = ['new york', 'new york city', 'nyc', 'manhattan', 'ny']
-        
-        if location not in valid_locations:
-            return {
-                'isValid': False,
-                'violatedSlot': 'Location',
-                'message': "I'm sorry, my database currently only has restaurants in New York City. Could you please say 'New York' or 'Manhattan'?"
-            }
+    location = slot_value(slots, 'Location')
+    if location and gazetteer.match_location(location) is None:
+        return {
+            'isValid': False,
+            'violatedSlot': 'Location',
+            'message': f"I'm sorry, my database currently only has restaurants in {', '.join(gazetteer.location_names()[:8])}. Where would you like to eat?"
+        }
+
+    # Validate Neighborhood (optional)
+    area = slot_value(slots, 'Neighborhood')
+    if area and resolve_area(area) is None:
+        return {
+            'isValid': False,
+            'violatedSlot': 'Neighborhood',
+            'message': "I don't know that area. Try a Manhattan neighborhood like SoHo or Chelsea, or a zip code."
+        }
 
     # Validate Date
     if slots.get('DiningDate') and slots['DiningDate'].get('value'):
@@ -57,9 +293,8 @@ def validate_slots(slots):
             # Parse Lex's date (YYYY-MM-DD)
             dining_date = datetime.datetime.strptime(date_str, '%Y-%m-%d').date()
             
-            # Get today's date in New York (UTC - 5 hours)
-            nyc_now = datetime.datetime.utcnow() - datetime.timedelta(hours=5)
-            today_date = nyc_now.date()
+            # Today's date where they want to eat
+            today_date = local_now(slots).date()
             
             if dining_date < today_date:
                 return {
@@ -95,10 +330,10 @@ def validate_slots(slots):
             # If they are booking for TODAY, make sure the time is in the future
             if slots.get('DiningDate') and slots['DiningDate'].get('value'):
                 date_str = slots['DiningDate']['value'].get('interpretedValue')
-                nyc_now = datetime.datetime.utcnow() - datetime.timedelta(hours=5)
+                now = local_now(slots)
                 
-                if date_str == str(nyc_now.date()):
-                    if dining_time < nyc_now.time():
+                if date_str == str(now.date()):
+                    if dining_time < now.time():
                         return {
                             'isValid': False,
                             'violatedSlot': 'DiningTime',
@@ -114,6 +349,15 @@ def validate_slots(slots):
     return {'isValid': True}
 
 def lambda_handler(event, context):
+    correlation_id = (event['sessionState'].get('sessionAttributes') or {}).get('correlationId')
+    intent_name = event['sessionState']['intent']['name']
+    try:
+        with metrics.timer('Handler'):
+            return handle_intent(event)
+    finally:
+        metrics.flush('LF1', correlation_id, Intent=intent_name, InvocationSource=event.get('invocationSource'))
+
+def handle_intent(event):
     intent_name = event['sessionState']['intent']['name']
     session_attributes = event['sessionState'].get('sessionAttributes', {})
     user_email = session_attributes.get('email')
@@ -121,11 +365,11 @@ def lambda_handler(event, context):
     if intent_name == 'GreetingIntent':
         if user_email:
             # Check DynamoDB 'UserHistory' table
-            history_table = boto3.resource('dynamodb').Table(HISTORY_TABLE)
-            response = history_table.get_item(Key={'Email': user_email}) 
+            history = get_history(event, user_email)
             
-            if 'Item' in response:
-                last_cuisine = response['Item']['LastCuisine']
+            if history:
+                remember_history(event, history)
+                last_cuisine = history['LastCuisine']
                 msg = f"Welcome back! Last time you looked for {last_cuisine}. Want to do that again or try something new?"
                 return close_dialog(event, msg)
         
@@ -166,24 +410,34 @@ def handle_dining_suggestions(event):
             time = slots.get('DiningTime', {}).get('value', {}).get('interpretedValue', 'Unknown')
             num_people = slots.get('NumberOfPeople', {}).get('value', {}).get('interpretedValue', 'Unknown')
             email = slots.get('Email', {}).get('value', {}).get('interpretedValue', 'Unknown')
+
+            # Canonical names, so "itallian food in nyc" is stored and searched as Italian in New York
+            cuisine_alias = gazetteer.match_cuisine(cuisine)
+            if cuisine_alias:
+                cuisine = gazetteer.cuisine_title(cuisine_alias)
+            matched_location = gazetteer.match_location(location)
+            location = gazetteer.location_city(matched_location) if matched_location else location
             
             sqs_message = {
                 "Location": location, "Cuisine": cuisine, "DiningTime": time, "DiningDate": date,
-                "NumberOfPeople": num_people, "Email": email
+                "NumberOfPeople": num_people, "Email": email,
+                "CorrelationId": event['sessionState'].get('sessionAttributes', {}).get('correlationId')
             }
+            if cuisine_alias:
+                sqs_message['CuisineAlias'] = cuisine_alias
+            area = slot_value(slots, 'Neighborhood')
+            if not area and matched_location and gazetteer.is_neighborhood(matched_location):
+                # "Italian in SoHo" names the area in the Location slot
+                area = matched_location
+            resolved = resolve_area(area) if area else None
+            if resolved:
+                sqs_message.update(resolved, Area=area)
             
-            sqs.send_message(QueueUrl=QUEUE_URL, MessageBody=json.dumps(sqs_message))
+            send_request(sqs_message)
             
-            # Initialize DynamoDB client and save the user's last search history
-            dynamo_history = boto3.resource('dynamodb').Table(HISTORY_TABLE)
-            dynamo_history.put_item(
-                Item={
-                    'Email': email,
-                    'LastCuisine': cuisine,
-                    'LastLocation': location
-                }
-            )
-            print(f"Saved history for {email}")
+            # Save the user's last search history
+            if save_history(event, email, cuisine, location):
+                print(f"Saved history for {email}")
 
             return close_dialog(event, f"I have received your request for {cuisine} food and will notify you at {email} shortly.")
         except Exception as e:
@@ -195,17 +449,19 @@ def handle_repeat_search(event):
     invocation_source = event['invocationSource']
     user_email = event['sessionState'].get('sessionAttributes', {}).get('email')
 
-    # Fetch past favorites from DynamoDB
-    history_table = boto3.resource('dynamodb').Table(HISTORY_TABLE)
-    response = history_table.get_item(Key={'Email': user_email})
-    cuisine = response['Item']['LastCuisine']
-    location = response['Item']['LastLocation']
-
     if invocation_source == 'DialogCodeHook':
         # Ask the user for the Date, Time, and Number of People
         return delegate_dialog(event)
 
     elif invocation_source == 'FulfillmentCodeHook':
+        # Past favorites are only needed now
+        history = get_history(event, user_email) if user_email else None
+        if not history:
+            return close_dialog(event, "I couldn't find a previous search for you. Try asking for restaurant suggestions instead!")
+        remember_history(event, history)
+        cuisine = history['LastCuisine']
+        location = history['LastLocation']
+
         date = slots.get('DiningDate', {}).get('value', {}).get('interpretedValue', 'Unknown')
         time = slots.get('DiningTime', {}).get('value', {}).get('interpretedValue', 'Unknown')
         num_people = slots.get('NumberOfPeople', {}).get('value', {}).get('interpretedValue', 'Unknown')
@@ -214,12 +470,12 @@ def handle_repeat_search(event):
         sqs_message = {
             "Location": location, "Cuisine": cuisine, 
             "DiningDate": date, "DiningTime": time,
-            "NumberOfPeople": num_people, "Email": user_email
+            "NumberOfPeople": num_people, "Email": user_email,
+            "CorrelationId": event['sessionState'].get('sessionAttributes', {}).get('correlationId')
         }
         
         # Send to SQS
-        sqs = boto3.client('sqs')
-        sqs.send_message(QueueUrl=QUEUE_URL, MessageBody=json.dumps(sqs_message))
+        send_request(sqs_message)
 
         return close_dialog(event, f"Perfect! I've put in a request for {cuisine} food in {location} for {num_people} people. I will email you at {user_email} shortly!")
     
@@ -227,6 +483,7 @@ def handle_repeat_search(event):
 def close_dialog(event, message):
     return {
         "sessionState": {
+            "sessionAttributes": event['sessionState'].get('sessionAttributes', {}),
             "dialogAction": {"type": "Close"},
             "intent": {
                 "name": event['sessionState']['intent']['name'],
@@ -239,6 +496,7 @@ def close_dialog(event, message):
 def delegate_dialog(event):
     return {
         "sessionState": {
+            "sessionAttributes": event['sessionState'].get('sessionAttributes', {}),
             "dialogAction": {"type": "Delegate"},
             "intent": event['sessionState']['intent']
         }
@@ -248,6 +506,7 @@ def delegate_dialog(event):
 def elicit_slot(event, violated_slot, message):
     return {
         "sessionState": {
+            "sessionAttributes": event['sessionState'].get('sessionAttributes', {}),
             "dialogAction": {
                 "type": "ElicitSlot",
                 "slotToElicit": violated_slot
@@ -257,3 +516,4 @@ def elicit_slot(event, violated_slot, message):
         "messages": [{"contentType": "PlainText", "content": message}]
     }
 
+metrics.init_done(_import_started)
@@ -1,108 +1,1166 @@
+import time
+_import_started = time.perf_counter()
+
 import json
-import boto3
-import urllib3
 import random
 import os
+import threading
+import math
+import heapq
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import clients
+import gazetteer
+import metrics
+from catalog_snapshot import Snapshot
 
-# CONFIGURATION (from environment variables)
-AWS_REGION = os.environ.get('AWS_REGION', 'us-east-1')
-OS_HOST = os.environ['OPENSEARCH_HOST']
+# CONFIGURATION (from environment variables). Nothing is required at import;
+# a missing setting only fails the call that needs it.
+OS_HOST = os.environ.get('OPENSEARCH_HOST')
 OS_INDEX = os.environ.get('OPENSEARCH_INDEX', 'restaurants')
-OS_AUTH = (os.environ['OPENSEARCH_USERNAME'], os.environ['OPENSEARCH_PASSWORD'])
-SENDER_EMAIL = os.environ['SENDER_EMAIL']
-SQS_QUEUE_URL = os.environ['SQS_QUEUE_URL']
+OS_AUTH = (os.environ.get('OPENSEARCH_USERNAME'), os.environ.get('OPENSEARCH_PASSWORD'))
+SENDER_EMAIL = os.environ.get('SENDER_EMAIL')
+SQS_QUEUE_URL = os.environ.get('SQS_QUEUE_URL')
 DYNAMODB_TABLE = os.environ.get('DYNAMODB_TABLE', 'yelp-restaurants')
+MAX_WORKERS = int(os.environ.get('LF2_MAX_WORKERS', '10'))
+CACHE_TTL = int(os.environ.get('RESTAURANT_CACHE_TTL', '900'))  # seconds
+CACHE_SIZE = int(os.environ.get('RESTAURANT_CACHE_SIZE', '2000'))
+# 'random_score' samples inside OpenSearch, 'shuffle' is the old fetch-20-and-shuffle,
+# 'index' reads random slots of the prebuilt cuisine index and skips OpenSearch
+SEARCH_MODE = os.environ.get('SEARCH_MODE', 'random_score')
+NUM_RECOMMENDATIONS = int(os.environ.get('NUM_RECOMMENDATIONS', '3'))
+RECENT_TTL = int(os.environ.get('RECENT_RECOMMENDATIONS_TTL', '86400'))  # seconds
+# Per-cuisine candidate sets: 'off' runs the SEARCH_MODE search on every batch,
+# 'memory', 'dynamodb' or 'file' cache every restaurant of each cuisine (the
+# last two as a shared tier behind the in-memory one) and sample from that
+CANDIDATE_CACHE = os.environ.get('CANDIDATE_CACHE', 'off')
+CANDIDATE_CACHE_TABLE = os.environ.get('CANDIDATE_CACHE_TABLE', 'RecommendationCache')
+CANDIDATE_CACHE_FILE = os.environ.get('CANDIDATE_CACHE_FILE', '/tmp/candidates.json')
+CANDIDATE_CACHE_TTL = int(os.environ.get('CANDIDATE_CACHE_TTL', '3600'))  # seconds
+CATALOG_VERSION_CHECK = int(os.environ.get('CATALOG_VERSION_CHECK', '60'))  # seconds
+# Built offline by other-scripts/build_recommendation_index.py
+RECOMMENDATION_INDEX_TABLE = os.environ.get('RECOMMENDATION_INDEX_TABLE', 'RecommendationIndex')
+# Catalog snapshot written by the loaders (a layer mounts it under /opt). While
+# it matches the catalog version, recommendations need no network calls.
+CATALOG_SNAPSHOT = os.environ.get('CATALOG_SNAPSHOT', '/opt/catalog.snapshot')
+# Requests with a neighborhood, zip or lat/lon get the closest restaurants
+# (blended with rating) instead of a random pick. Needs the snapshot and NumPy.
+PROXIMITY_RANKING = os.environ.get('PROXIMITY_RANKING', 'true').lower() in ('1', 'true', 'yes')
+PROXIMITY_RATING_WEIGHT = float(os.environ.get('PROXIMITY_RATING_WEIGHT', '0.3'))
+PROXIMITY_SCALE_KM = float(os.environ.get('PROXIMITY_SCALE_KM', '1.0'))
+PROXIMITY_POOL = int(os.environ.get('PROXIMITY_POOL', '50'))
+# How long a request this container already emailed is dropped if it shows up
+# again (a redelivery, or a duplicate LF1 couldn't catch)
+REQUEST_DEDUPE_TTL = int(os.environ.get('REQUEST_DEDUPE_TTL', '600'))  # seconds
+SES_TEMPLATE_NAME = os.environ.get('SES_TEMPLATE_NAME', 'DiningRecommendations')
+# maxReceiveCount of the queue's redrive policy, only used for logging
+MAX_RECEIVE_COUNT = int(os.environ.get('MAX_RECEIVE_COUNT', '5'))
+# Keep receiving batches until the queue is empty or the Lambda is about to
+# run out of time
+DRAIN_QUEUE = os.environ.get('DRAIN_QUEUE', 'true').lower() in ('1', 'true', 'yes')
+DRAIN_SAFETY_MARGIN_MS = int(os.environ.get('DRAIN_SAFETY_MARGIN_MS', '10000'))
+# A failed message stays hidden for RETRY_BACKOFF_SECONDS * 2^receive count,
+# at most RETRY_BACKOFF_MAX, so a message that keeps failing isn't retried
+# (and emailed) in a tight loop before the redrive policy dead-letters it
+RETRY_BACKOFF_SECONDS = int(os.environ.get('RETRY_BACKOFF_SECONDS', '15'))
+RETRY_BACKOFF_MAX = int(os.environ.get('RETRY_BACKOFF_MAX', '900'))
 # -------------------------------------
 
-# Initialize AWS clients
-dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION)
-ses = boto3.client('ses', region_name=AWS_REGION)
-sqs = boto3.client('sqs', region_name=AWS_REGION)
+# AWS clients and the OpenSearch connection pool are built on first use, so an
+# empty poll only loads what it needs for SQS (clients are thread safe,
+# resources are not, so the DynamoDB resource is only used from the handler thread)
+def dynamodb():
+    return clients.resource('dynamodb')
+
+def ses():
+    return clients.client('ses')
+
+def sqs():
+    return clients.client('sqs')
+
+http_state = {'pool': None}
+
+def http():
+    if http_state['pool'] is None:
+        import urllib3
+        http_state['pool'] = urllib3.PoolManager(maxsize=MAX_WORKERS)
+    return http_state['pool']
+
+# Restaurant details cache, survives between invocations on a warm container
+# Business ID -> (expires_at, {'Name': ..., 'Address': ...})
+restaurant_cache = OrderedDict()
+cache_stats = {'hits': 0, 'misses': 0}
 
-http = urllib3.PoolManager()
+# Restaurants already emailed to each user from this container
+# Email -> [(sent_at, Business ID), ...]
+recently_sent = {}
+recent_lock = threading.Lock()
+
+# Requests emailed from this container: request key -> expires_at
+handled_requests = {}
+
+# Cuisine alias -> (catalog version, expires_at, [{'id', 'weight'}, ...])
+candidate_cache = {}
+catalog_state = {'version': None, 'checked_at': 0, 'missing_table': False}
+
+# Cuisine alias -> (catalog version, expires_at, number of slots in the index)
+index_counts = {}
+
+# The mapped snapshot, reopened when the file changes
+# candidates: cuisine alias -> [{'id', 'row', 'weight'}, ...]
+# geo: cuisine alias -> proximity.GeoIndex, zips: zip code -> (lat, lon) or None
+snapshot_state = {'snapshot': None, 'mtime': None, 'candidates': {}, 'geo': {}, 'zips': {}}
+
+# Stored SES template for the recommendation email, registered once per container
+EMAIL_TEMPLATE = {
+    'TemplateName': SES_TEMPLATE_NAME,
+    'SubjectPart': 'Your Dining Recommendations',
+    'TextPart': (
+        "{{#if recommendations}}"
+        "Hello! Here are my {{{cuisine}}} restaurant suggestions for {{{num_people}}} people, for {{{date}}} at {{{time}}}:\n\n"
+        "{{#each recommendations}}{{number}}. {{{text}}}\n{{/each}}"
+        "\nEnjoy your meal!"
+        "{{else}}"
+        "Hello! We couldn't find any {{{cuisine}}} restaurants in our database right now. Please try another cuisine!"
+        "{{/if}}"
+    )
+}
+template_state = {'ready': False}
+
+MSEARCH_POOL_MAX = 100
+SES_BULK_LIMIT = 50
+CANDIDATE_PAGE_SIZE = 1000
+# Shared candidate sets are split into items below DynamoDB's 400 KB limit
+CANDIDATE_CHUNK_BYTES = 300000
+BATCH_GET_LIMIT = 100
+BATCH_GET_RETRIES = 5
+SQS_BATCH_LIMIT = 10
+LONG_POLL_SECONDS = 20
 
 def lambda_handler(event, context):
-    # Actively poll SQS for new messages
-    response = sqs.receive_message(
+    # Invoked by an SQS event source mapping: Lambda deletes the messages we
+    # don't report as failed (needs ReportBatchItemFailures on the mapping)
+    if event and event.get('Records'):
+        messages = [from_record(record) for record in event['Records'] if record.get('eventSource') == 'aws:sqs']
+        summary = process_batch(messages, self_managed=False)
+        return {
+            'batchItemFailures': [
+                {'itemIdentifier': result['messageId']}
+                for result in summary['messages'] if result['status'] == 'error'
+            ]
+        }
+
+    # Otherwise actively poll SQS for new messages
+    if DRAIN_QUEUE:
+        return drain_queue(context)
+
+    messages = receive_batch(2)
+    
+    #If the queue is empty, exit
+    if not messages:
+        print("No new requests in queue. Waiting for next minute...")
+        return
+
+    return process_batch(messages, self_managed=True)
+
+def receive_batch(wait_seconds):
+    response = sqs().receive_message(
         QueueUrl=SQS_QUEUE_URL,
         MaxNumberOfMessages=10, 
-        WaitTimeSeconds=2
+        WaitTimeSeconds=wait_seconds,
+        AttributeNames=['ApproximateReceiveCount']
     )
-    
-    #If the queue is empty, exit
-    if 'Messages' not in response:
+    return response.get('Messages', [])
+
+def poll_seconds(context):
+    # Long poll, but never into the time we need to finish a batch
+    remaining_ms = context.get_remaining_time_in_millis() if context else 0
+    return int(min(LONG_POLL_SECONDS, max(0, (remaining_ms - DRAIN_SAFETY_MARGIN_MS) / 1000)))
+
+def drain_queue(context):
+    totals = {'batches': 0, 'processed': 0, 'skipped': 0, 'duplicates': 0, 'failed': 0}
+    # Messages that already failed in this invocation
+    failed_ids = set()
+
+    # The next batch is received in the background while this one is processed
+    with ThreadPoolExecutor(max_workers=1) as receiver:
+        upcoming = receiver.submit(receive_batch, max(poll_seconds(context), 1))
+        while upcoming:
+            messages = upcoming.result()
+            if not messages:
+                break
+
+            # A failure that comes back before this invocation ends isn't
+            # tried again here, it goes back with a longer backoff
+            retried = [message for message in messages if message['MessageId'] in failed_ids]
+            if retried:
+                release_messages(retried, failed_ids)
+                messages = [message for message in messages if message['MessageId'] not in failed_ids]
+                if not messages:
+                    print(f"Only messages that already failed are left ({len(retried)}), done draining.")
+                    break
+
+            wait_seconds = poll_seconds(context)
+            upcoming = receiver.submit(receive_batch, wait_seconds) if wait_seconds > 0 else None
+
+            summary = process_batch(messages, self_managed=True)
+            totals['batches'] += 1
+            for key in ('processed', 'skipped', 'duplicates', 'failed'):
+                totals[key] += summary[key]
+            failed_ids.update(result['messageId'] for result in summary['messages'] if result['status'] == 'error')
+
+            # Out of time: hand back anything we already received
+            if upcoming and poll_seconds(context) <= 0:
+                release_messages(upcoming.result(), failed_ids)
+                upcoming = None
+
+    if not totals['batches']:
         print("No new requests in queue. Waiting for next minute...")
         return
-        
-    # Process the messages
-    for message in response['Messages']:
-        receipt_handle = message['ReceiptHandle']
+    print(json.dumps(dict(totals, drained=True)))
+    return totals
+
+def retry_delay(receive_count):
+    return min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_SECONDS * 2 ** max(receive_count, 1))
+
+def release_messages(messages, failed_ids):
+    # Messages we never got to are visible again right away, ones that
+    # already failed wait out their backoff
+    for i in range(0, len(messages), SQS_BATCH_LIMIT):
+        sqs().change_message_visibility_batch(
+            QueueUrl=SQS_QUEUE_URL,
+            Entries=[
+                {
+                    'Id': str(j),
+                    'ReceiptHandle': message['ReceiptHandle'],
+                    'VisibilityTimeout': retry_delay(int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1)))
+                    if message['MessageId'] in failed_ids else 0
+                }
+                for j, message in enumerate(messages[i:i + SQS_BATCH_LIMIT])
+            ]
+        )
+
+def from_record(record):
+    # Event source records use different key names than receive_message
+    return {
+        'MessageId': record['messageId'],
+        'ReceiptHandle': record['receiptHandle'],
+        'Body': record['body'],
+        'Attributes': record.get('attributes', {})
+    }
+
+def process_batch(messages, self_managed):
+    batch_start = time.perf_counter()
+    workers = max(1, min(MAX_WORKERS, len(messages)))
+
+    jobs = [parse_message(message) for message in messages]
+    # Identical requests get one search and one email
+    collapse_duplicates(jobs)
+    snapshot = current_snapshot()
+    if snapshot:
+        # Stages 1 and 2 straight from the mapped snapshot, whatever it
+        # couldn't answer goes to OpenSearch and DynamoDB
+        remaining = recommend_from_snapshot(jobs, snapshot)
+    else:
+        remaining = jobs
+    if remaining:
+        recommend_from_network(remaining)
+
+    # Stage 3: bulk templated emails, up to 50 recipients per SES call
+    send_batch(jobs, workers)
+
+    # Stage 4: delete what was handled, hand failures back to the queue
+    if self_managed:
+        finish_batch(jobs)
+    log_failures(jobs)
+
+    results = []
+    for job in jobs:
+        result = {'messageId': job['messageId'], 'status': job['status'], 'timings_ms': job['timings_ms']}
+        if job['status'] == 'duplicate':
+            result['duplicateOf'] = job['duplicate_of']
+        if job['status'] == 'error':
+            result['error'] = job['error']
+            result['receiveCount'] = job['receive_count']
+        results.append(result)
+
+    summary = {
+        'processed': sum(1 for r in results if r['status'] == 'ok'),
+        'skipped': sum(1 for r in results if r['status'] == 'skipped'),
+        'duplicates': sum(1 for r in results if r['status'] == 'duplicate'),
+        'failed': sum(1 for r in results if r['status'] == 'error'),
+        'batch_ms': round((time.perf_counter() - batch_start) * 1000, 1),
+        'restaurant_cache': dict(cache_stats, size=len(restaurant_cache)),
+        'catalog_version': catalog_state['version'],
+        'messages': results
+    }
+    print(json.dumps(summary))
+
+    # One metrics line per message, carrying the ID LF0 gave the request
+    for job in jobs:
+        metrics.emit('LF2', job['timings_ms'], CorrelationId=job['correlation_id'], Status=job['status'])
+    metrics.record('Batch', summary['batch_ms'])
+    metrics.count('Processed', summary['processed'])
+    metrics.count('Failed', summary['failed'])
+    metrics.flush('LF2')
+    return summary
+
+def recommend_from_network(jobs):
+    if SEARCH_MODE == 'index':
+        # Stages 1 and 2 in one BatchGetItem against the cuisine index
+        recommend_from_index(jobs)
+    elif CANDIDATE_CACHE == 'off':
+        # Stage 1: one _msearch covering every cuisine in the batch
+        search_batch(jobs)
+        # Stage 2: one batched DynamoDB lookup for every restaurant in the batch
+        render_batch(jobs)
+    else:
+        # Stages 1 and 2 are usually a sample from a warm candidate set
+        recommend_from_candidates(jobs)
+
+def elapsed_ms(since):
+    return round((time.perf_counter() - since) * 1000, 1)
+
+def parse_message(message):
+    job = {
+        'messageId': message.get('MessageId'),
+        'receipt_handle': message['ReceiptHandle'],
+        'status': 'ok',
+        'restaurant_ids': [],
+        'recommendations': [],
+        'correlation_id': message.get('MessageId'),
+        'receive_count': int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1)),
+        'timings_ms': {}
+    }
+    try:
         message_body = json.loads(message['Body'])
-        
-        cuisine = message_body.get('Cuisine')
-        location = message_body.get('Location')
-        date = message_body.get('DiningDate', 'today')
-        time = message_body.get('DiningTime')
-        num_people = message_body.get('NumberOfPeople')
-        user_email = message_body.get('Email')
-        
-        if not cuisine or not user_email:
+        job['cuisine'] = message_body.get('Cuisine')
+        job['location'] = message_body.get('Location')
+        job['date'] = message_body.get('DiningDate', 'today')
+        job['time'] = message_body.get('DiningTime')
+        job['num_people'] = message_body.get('NumberOfPeople')
+        job['email'] = message_body.get('Email')
+        job['correlation_id'] = message_body.get('CorrelationId') or job['messageId']
+        # Set by LF1 when the user named a neighborhood, zip or lat/lon
+        if message_body.get('Latitude') is not None and message_body.get('Longitude') is not None:
+            job['point'] = (float(message_body['Latitude']), float(message_body['Longitude']))
+        job['zip_code'] = message_body.get('ZipCode')
+        job['request_key'] = message_body.get('RequestKey')
+
+        if not job['cuisine'] or not job['email']:
             print("Missing cuisine or email, skipping.")
-            sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=receipt_handle)
+            job['status'] = 'skipped'
+            return job
+
+        # LF1 sends the Yelp category alias, older messages and history only have the name
+        job['cuisine_alias'] = message_body.get('CuisineAlias') or gazetteer.match_cuisine(job['cuisine']) or job['cuisine'].lower()
+    except Exception as e:
+        print("Error reading message:", str(e))
+        job['status'] = 'error'
+        job['error'] = str(e)
+    return job
+
+def collapse_duplicates(jobs):
+    # Same request key in this batch, or already emailed from this container
+    now = time.time()
+    for key, expires_at in list(handled_requests.items()):
+        if expires_at <= now:
+            del handled_requests[key]
+
+    first = {}
+    for job in jobs:
+        if job['status'] != 'ok':
             continue
+        # Messages from before LF1 sent keys are compared field by field
+        key = job['request_key'] or (job['email'].lower(), job['cuisine_alias'], job['date'], job['time'],
+                                     job['num_people'], job.get('point'), job['zip_code'])
+        job['dedupe_key'] = key
+        if key in handled_requests:
+            job['status'] = 'duplicate'
+            job['duplicate_of'] = 'earlier batch'
+        elif key in first:
+            job['status'] = 'duplicate'
+            job['duplicate_of'] = first[key]['messageId']
+        else:
+            first[key] = job
+    duplicates = sum(1 for job in jobs if job['status'] == 'duplicate')
+    if duplicates:
+        print(f"Dropped {duplicates} duplicate request(s)")
+        metrics.count('DuplicateRequests', duplicates)
 
-        cuisine_alias = cuisine.lower()
-        if cuisine_alias == 'indian':
-            cuisine_alias = 'indpak'
-            
-        print(f"Looking for {cuisine_alias} restaurants for {user_email}...")
-        
-        # Query OpenSearch for the Cuisine
-        headers = urllib3.util.make_headers(basic_auth=f"{OS_AUTH[0]}:{OS_AUTH[1]}")
-        headers['Content-Type'] = 'application/json'
-        
-        search_url = f"{OS_HOST}/{OS_INDEX}/_search?q=Cuisine:{cuisine_alias}&size=20"
-        
+def group_by_cuisine(jobs):
+    groups = {}
+    for job in jobs:
+        if job['status'] == 'ok':
+            groups.setdefault(job['cuisine_alias'], []).append(job)
+    return groups
+
+def search_batch(jobs):
+    # Messages asking for the same cuisine share one candidate pool
+    groups = group_by_cuisine(jobs)
+    if not groups:
+        return
+
+    searches = []
+    pool_sizes = {}
+    excluded = {}
+    for cuisine_alias, group in groups.items():
+        print(f"Looking for {cuisine_alias} restaurants for {len(group)} request(s)...")
+        for job in group:
+            job['exclude_ids'] = set(recent_restaurants(job['email'])) if SEARCH_MODE != 'shuffle' else set()
+        # The group shares one pool, so a place recently sent to any of them
+        # is left out for all of them
+        excluded[cuisine_alias] = set().union(*(job['exclude_ids'] for job in group))
+        pool_sizes[cuisine_alias] = min(MSEARCH_POOL_MAX, NUM_RECOMMENDATIONS * len(group))
+        if SEARCH_MODE == 'shuffle':
+            searches.append(build_shuffle_query(cuisine_alias))
+        else:
+            searches.append(build_random_query(cuisine_alias, pool_sizes[cuisine_alias], excluded[cuisine_alias]))
+
+    stage = time.perf_counter()
+    try:
+        responses = msearch(searches)
+        # The group has already seen most of the cuisine, search again
+        # allowing repeats
+        short = [
+            cuisine_alias for cuisine_alias, response in zip(groups, responses)
+            if 'error' not in response and excluded[cuisine_alias]
+            and len(response.get('hits', {}).get('hits', [])) < NUM_RECOMMENDATIONS
+        ]
+        if short:
+            repeats = dict(zip(short, msearch([build_random_query(alias, pool_sizes[alias]) for alias in short])))
+            for i, cuisine_alias in enumerate(groups):
+                if cuisine_alias in repeats and 'error' not in repeats[cuisine_alias]:
+                    hits = responses[i]['hits']['hits'] + repeats[cuisine_alias].get('hits', {}).get('hits', [])
+                    responses[i] = {'hits': {'hits': hits}}
+    except Exception as e:
+        print("Error searching for recommendations:", str(e))
+        responses = [{'error': str(e)}] * len(searches)
+    search_ms = elapsed_ms(stage)
+
+    for (cuisine_alias, group), response in zip(groups.items(), responses):
+        for job in group:
+            job['timings_ms']['search'] = search_ms
+            if 'error' in response:
+                job['status'] = 'error'
+                job['error'] = f"search failed: {response['error']}"
+                continue
+            hits = response.get('hits', {}).get('hits', [])
+            candidates = list(dict.fromkeys(hit['_source']['RestaurantID'] for hit in hits))
+            job['restaurant_ids'] = pick_restaurants(candidates, job['exclude_ids'], NUM_RECOMMENDATIONS)
+
+def pick_restaurants(candidates, exclude_ids, k):
+    # Prefer places this user hasn't been sent yet, allow repeats if we run out
+    fresh = [rid for rid in candidates if rid not in exclude_ids]
+    picks = random.sample(fresh, min(k, len(fresh)))
+    if len(picks) < k:
+        seen = [rid for rid in candidates if rid in exclude_ids]
+        picks += random.sample(seen, min(k - len(picks), len(seen)))
+    return picks
+
+def render_restaurant(item):
+    name = item.get('Name', 'Unknown Name')
+    address = item.get('Address', 'Unknown Address')
+    return f"{name}, located at {address}"
+
+def render_batch(jobs):
+    stage = time.perf_counter()
+    wanted = {rid for job in jobs if job['status'] == 'ok' for rid in job['restaurant_ids']}
+    try:
+        restaurants = fetch_restaurants(wanted)
+    except Exception as e:
+        print("Error fetching restaurant details:", str(e))
+        restaurants = None
+    dynamodb_ms = elapsed_ms(stage)
+
+    for job in jobs:
+        if job['status'] != 'ok':
+            continue
+        if restaurants is None:
+            job['status'] = 'error'
+            job['error'] = 'restaurant lookup failed'
+            continue
+        job['timings_ms']['dynamodb'] = dynamodb_ms
+        job['recommendations'] = [render_restaurant(restaurants[rid]) for rid in job['restaurant_ids'] if rid in restaurants]
+
+def recommend_from_candidates(jobs):
+    groups = group_by_cuisine(jobs)
+    if not groups:
+        return
+
+    stage = time.perf_counter()
+    try:
+        candidates = get_candidates(list(groups))
+    except Exception as e:
+        print("Error loading candidate sets:", str(e))
+        candidates = None
+    candidates_ms = elapsed_ms(stage)
+
+    for cuisine_alias, group in groups.items():
+        for job in group:
+            job['timings_ms']['candidates'] = candidates_ms
+            if candidates is None:
+                job['status'] = 'error'
+                job['error'] = 'candidate lookup failed'
+                continue
+            picks = pick_weighted(candidates.get(cuisine_alias, []), set(recent_restaurants(job['email'])), NUM_RECOMMENDATIONS)
+            job['restaurant_ids'] = [c['id'] for c in picks]
+            job['recommendations'] = [c['text'] for c in picks]
+
+def recommend_from_snapshot(jobs, snapshot):
+    # Returns the jobs it couldn't answer
+    remaining = []
+    for cuisine_alias, group in group_by_cuisine(jobs).items():
+        stage = time.perf_counter()
+        located = [job for job in group if job.get('point') or job.get('zip_code')] if PROXIMITY_RANKING else []
+        try:
+            nearby = {id(job) for job in recommend_nearby(snapshot, cuisine_alias, located)} if located else set()
+        except Exception as e:
+            # Those requests get a weighted random pick instead
+            print(f"Error ranking {cuisine_alias} restaurants by distance:", str(e))
+            nearby = set()
+        try:
+            candidates = snapshot_candidates(snapshot, cuisine_alias)
+        except Exception as e:
+            print(f"Error reading {cuisine_alias} restaurants from the catalog snapshot:", str(e))
+            candidates = None
+        for job in group:
+            if id(job) in nearby:
+                continue
+            if candidates is None:
+                remaining.append(job)
+                continue
+            try:
+                picks = pick_weighted(candidates, set(recent_restaurants(job['email'])), NUM_RECOMMENDATIONS)
+                restaurants = [snapshot.row(c['row']) for c in picks]
+                job['restaurant_ids'] = [r['Business ID'] for r in restaurants]
+                job['recommendations'] = [render_restaurant(r) for r in restaurants]
+            except Exception as e:
+                print(f"Error reading recommendations for {job['messageId']} from the catalog snapshot:", str(e))
+                job.pop('restaurant_ids', None)
+                job.pop('recommendations', None)
+                remaining.append(job)
+        snapshot_ms = elapsed_ms(stage)
+        for job in group:
+            job['timings_ms']['snapshot'] = snapshot_ms
+    return remaining
+
+def recommend_nearby(snapshot, cuisine_alias, jobs):
+    # Returns the jobs it handled, the rest get a weighted random pick
+    try:
+        import proximity
+    except ImportError:
+        print("NumPy isn't available, ignoring the requested area")
+        return []
+
+    for job in jobs:
+        if not job.get('point'):
+            job['point'] = zip_point(snapshot, proximity, job['zip_code'])
+    jobs = [job for job in jobs if job['point']]
+    if not jobs:
+        return []
+
+    index = snapshot_state['geo'].get(cuisine_alias)
+    if index is None:
+        index = proximity.GeoIndex(snapshot.table(), snapshot.rows(cuisine_alias), snapshot.string_bytes())
+        snapshot_state['geo'][cuisine_alias] = index
+
+    # Every request for this cuisine in one scoring pass
+    points = [job['point'] for job in jobs]
+    pool = max(PROXIMITY_POOL, NUM_RECOMMENDATIONS)
+    candidates = [index.nearby(lat, lon, pool) for lat, lon in points]
+    excluded = []
+    for job, positions in zip(jobs, candidates):
+        exclude_ids = set(recent_restaurants(job['email']))
+        if not exclude_ids:
+            excluded.append(None)
+            continue
+        excluded.append(index.excluded(positions, exclude_ids))
+    ranked = index.top_k(candidates, points, NUM_RECOMMENDATIONS, excluded, PROXIMITY_RATING_WEIGHT, PROXIMITY_SCALE_KM)
+
+    for job, (job_rows, job_distances) in zip(jobs, ranked):
+        restaurants = [snapshot.row(int(row)) for row in job_rows]
+        job['restaurant_ids'] = [r['Business ID'] for r in restaurants]
+        job['recommendations'] = [f"{render_restaurant(r)} ({km:.1f} km away)" for r, km in zip(restaurants, job_distances)]
+    return jobs
+
+def zip_point(snapshot, proximity, zip_code):
+    if zip_code not in snapshot_state['zips']:
+        snapshot_state['zips'][zip_code] = proximity.zip_centroid(snapshot.table(), snapshot.string_bytes(), zip_code)
+    return snapshot_state['zips'][zip_code]
+
+def recommend_from_index(jobs):
+    groups = group_by_cuisine(jobs)
+    if not groups:
+        return
+
+    stage = time.perf_counter()
+    try:
+        counts = index_slot_counts(list(groups))
+        wanted = {}
+        for cuisine_alias, group in groups.items():
+            for job in group:
+                job['exclude_ids'] = set(recent_restaurants(job['email']))
+                # Draw a few spare slots so recently sent places can be skipped
+                n = min(counts.get(cuisine_alias, 0), NUM_RECOMMENDATIONS + len(job['exclude_ids']))
+                job['slots'] = random.sample(range(1, counts.get(cuisine_alias, 0) + 1), n)
+                wanted.update({(cuisine_alias, slot): None for slot in job['slots']})
+        slots = fetch_index_slots(list(wanted))
+    except Exception as e:
+        print("Error reading the recommendation index:", str(e))
+        slots = None
+    index_ms = elapsed_ms(stage)
+
+    for cuisine_alias, group in groups.items():
+        for job in group:
+            job['timings_ms']['index'] = index_ms
+            if slots is None:
+                job['status'] = 'error'
+                job['error'] = 'index lookup failed'
+                continue
+            items = [slots[(cuisine_alias, slot)] for slot in job['slots'] if (cuisine_alias, slot) in slots]
+            picks = [item for item in items if item['Business ID'] not in job['exclude_ids']][:NUM_RECOMMENDATIONS]
+            if len(picks) < NUM_RECOMMENDATIONS:
+                picks += [item for item in items if item['Business ID'] in job['exclude_ids']][:NUM_RECOMMENDATIONS - len(picks)]
+            job['restaurant_ids'] = [item['Business ID'] for item in picks]
+            job['recommendations'] = [render_restaurant(item) for item in picks]
+
+def send_batch(jobs, workers):
+    ready = [job for job in jobs if job['status'] == 'ok']
+    if not ready:
+        return
+
+    if not ensure_template():
+        # No stored template, fall back to one email per message
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(send_single, ready))
+        return
+
+    for i in range(0, len(ready), SES_BULK_LIMIT):
+        chunk = ready[i:i + SES_BULK_LIMIT]
+        stage = time.perf_counter()
         try:
-            os_response = http.request('GET', search_url, headers=headers)
-            os_data = json.loads(os_response.data.decode('utf-8'))
-            hits = os_data.get('hits', {}).get('hits', [])
-            
-            if not hits:
-                send_email(user_email, cuisine, date, time, num_people, [])
+            response = ses().send_bulk_templated_email(
+                Source=SENDER_EMAIL,
+                Template=SES_TEMPLATE_NAME,
+                DefaultTemplateData=json.dumps({'cuisine': 'restaurant', 'recommendations': []}),
+                Destinations=[
+                    {
+                        'Destination': {'ToAddresses': [job['email']]},
+                        'ReplacementTemplateData': json.dumps(template_data(job))
+                    }
+                    for job in chunk
+                ]
+            )
+            statuses = response['Status']
+        except Exception as e:
+            print("Error sending bulk email:", str(e))
+            statuses = [{'Status': 'Failed', 'Error': str(e)}] * len(chunk)
+        ses_ms = elapsed_ms(stage)
+
+        # Statuses come back in the same order as the destinations
+        for job, status in zip(chunk, statuses):
+            job['timings_ms']['ses'] = ses_ms
+            if status.get('MessageId') and status.get('Status', 'Success') == 'Success':
+                remember_sent(job['email'], job['restaurant_ids'])
+                handled_requests[job['dedupe_key']] = time.time() + REQUEST_DEDUPE_TTL
+                print(f"Successfully processed and emailed recommendations to {job['email']}")
             else:
-                # Pick random restaurants from the hits (3 recommendations)
-                random.shuffle(hits)
-                selected_hits = hits[:3]
-                
-                # Query DynamoDB for the full restaurant details
-                table = dynamodb.Table(DYNAMODB_TABLE)
-                recommendations = []
-                
-                for hit in selected_hits:
-                    restaurant_id = hit['_source']['RestaurantID']
-                    
-                    # Fetch from DynamoDB
-                    db_response = table.get_item(Key={'Business ID': restaurant_id})
-                    if 'Item' in db_response:
-                        item = db_response['Item']
-                        name = item.get('Name', 'Unknown Name')
-                        address = item.get('Address', 'Unknown Address')
-                        recommendations.append(f"{name}, located at {address}")
-                
-                # Send the Email via SES
-                send_email(user_email, cuisine, date, time, num_people, recommendations)
-                print(f"Successfully processed and emailed recommendations to {user_email}")
-            
-            # DELETE THE MESSAGE FROM SQS SO WE DON'T EMAIL THEM AGAIN!
-            sqs.delete_message(
+                job['status'] = 'error'
+                job['error'] = f"email failed: {status.get('Status')} {status.get('Error', '')}".strip()
+
+def send_single(job):
+    stage = time.perf_counter()
+    try:
+        send_email(job['email'], job['cuisine'], job['date'], job['time'], job['num_people'], job['recommendations'])
+        remember_sent(job['email'], job['restaurant_ids'])
+        handled_requests[job['dedupe_key']] = time.time() + REQUEST_DEDUPE_TTL
+        print(f"Successfully processed and emailed recommendations to {job['email']}")
+    except Exception as e:
+        job['status'] = 'error'
+        job['error'] = f"email failed: {str(e)}"
+    job['timings_ms']['ses'] = elapsed_ms(stage)
+
+def template_data(job):
+    return {
+        'cuisine': job['cuisine'],
+        'num_people': str(job['num_people']),
+        'date': str(job['date']),
+        'time': str(job['time']),
+        'recommendations': [{'number': i, 'text': rec} for i, rec in enumerate(job['recommendations'], 1)]
+    }
+
+def ensure_template():
+    if template_state['ready']:
+        return True
+    try:
+        try:
+            current = ses().get_template(TemplateName=SES_TEMPLATE_NAME)['Template']
+            if current.get('TextPart') != EMAIL_TEMPLATE['TextPart'] or current.get('SubjectPart') != EMAIL_TEMPLATE['SubjectPart']:
+                ses().update_template(Template=EMAIL_TEMPLATE)
+        except ses().exceptions.TemplateDoesNotExistException:
+            ses().create_template(Template=EMAIL_TEMPLATE)
+        template_state['ready'] = True
+    except Exception as e:
+        print("Error registering email template:", str(e))
+    return template_state['ready']
+
+def finish_batch(jobs):
+    done = [job for job in jobs if job['status'] != 'error']
+    failed = [job for job in jobs if job['status'] == 'error']
+
+    # DELETE THE MESSAGES FROM SQS SO WE DON'T EMAIL THEM AGAIN!
+    stage = time.perf_counter()
+    for chunk in sqs_batches(done):
+        try:
+            response = sqs().delete_message_batch(
+                QueueUrl=SQS_QUEUE_URL,
+                Entries=[{'Id': str(i), 'ReceiptHandle': job['receipt_handle']} for i, job in enumerate(chunk)]
+            )
+            for failure in response.get('Failed', []):
+                job = chunk[int(failure['Id'])]
+                print(f"Couldn't delete message {job['messageId']}: {failure.get('Message')}")
+        except Exception as e:
+            print("Error deleting messages:", str(e))
+    delete_ms = elapsed_ms(stage)
+    for job in done:
+        job['timings_ms']['delete'] = delete_ms
+    if done:
+        print(f"Deleted {len(done)} messages from SQS.")
+
+    # Failures come back after a backoff that grows with every attempt
+    stage = time.perf_counter()
+    for chunk in sqs_batches(failed):
+        try:
+            sqs().change_message_visibility_batch(
                 QueueUrl=SQS_QUEUE_URL,
-                ReceiptHandle=receipt_handle
+                Entries=[
+                    {'Id': str(i), 'ReceiptHandle': job['receipt_handle'], 'VisibilityTimeout': retry_delay(job['receive_count'])}
+                    for i, job in enumerate(chunk)
+                ]
             )
-            print("Message deleted from SQS successfully.")
-            
         except Exception as e:
-            print("Error processing recommendation:", str(e))
+            print("Error returning messages to the queue:", str(e))
+    requeue_ms = elapsed_ms(stage)
+    for job in failed:
+        job['timings_ms']['requeue'] = requeue_ms
+
+def sqs_batches(jobs):
+    for i in range(0, len(jobs), SQS_BATCH_LIMIT):
+        yield jobs[i:i + SQS_BATCH_LIMIT]
+
+def log_failures(jobs):
+    for job in jobs:
+        if job['status'] != 'error':
+            continue
+        if job['receive_count'] >= MAX_RECEIVE_COUNT:
+            print(f"Message {job['messageId']} failed on its last attempt ({job['receive_count']}/{MAX_RECEIVE_COUNT}), it will go to the dead-letter queue: {job['error']}")
+        else:
+            print(f"Message {job['messageId']} failed on attempt {job['receive_count']}/{MAX_RECEIVE_COUNT}, it will be retried in {retry_delay(job['receive_count'])}s: {job['error']}")
+
+# OPENSEARCH QUERIES
+def build_shuffle_query(cuisine_alias):
+    # The old behavior: the first 20 matches, shuffled by the caller
+    return {
+        'size': 20,
+        '_source': ['RestaurantID'],
+        'query': {'match': {'Cuisine': cuisine_alias}}
+    }
+
+def build_random_query(cuisine_alias, size, exclude_ids=()):
+    # Random order over the whole cuisine, nudged towards well rated and well
+    # reviewed places, returning only the IDs we need
+    query = {'bool': {'filter': [{'term': {'Cuisine': cuisine_alias}}]}}
+    if exclude_ids:
+        query['bool']['must_not'] = [{'ids': {'values': sorted(exclude_ids)}}]
+    return {
+        'size': size,
+        '_source': ['RestaurantID'],
+        'query': {
+            'function_score': {
+                'query': query,
+                'functions': [
+                    {'random_score': {}},
+                    {'field_value_factor': {'field': 'Rating', 'modifier': 'none', 'missing': 3}},
+                    {'field_value_factor': {'field': 'Number of Reviews', 'modifier': 'log2p', 'missing': 1}}
+                ],
+                'score_mode': 'multiply',
+                'boost_mode': 'replace'
+            }
+        }
+    }
+
+def msearch(searches):
+    # One round trip for every search, responses come back in the same order
+    if not OS_HOST:
+        raise Exception("OPENSEARCH_HOST isn't set")
+    from urllib3.util import make_headers
+    headers = make_headers(basic_auth=f"{OS_AUTH[0]}:{OS_AUTH[1]}")
+    headers['Content-Type'] = 'application/x-ndjson'
+
+    lines = []
+    for search in searches:
+        lines.append('{}')
+        lines.append(json.dumps(search))
+    body = '\n'.join(lines) + '\n'
+
+    with metrics.timer('opensearch.msearch'):
+        os_response = http().request('POST', f"{OS_HOST}/{OS_INDEX}/_msearch", headers=headers, body=body.encode('utf-8'))
+    if os_response.status >= 300:
+        raise Exception(f"_msearch returned {os_response.status}")
+    return json.loads(os_response.data.decode('utf-8'))['responses']
+
+def build_candidate_query(cuisine_alias, search_after=None):
+    # One page of the cuisine in RestaurantID order, with what we need to weight it
+    query = {
+        'size': CANDIDATE_PAGE_SIZE,
+        '_source': ['RestaurantID', 'Rating', 'Number of Reviews'],
+        'query': {'bool': {'filter': [{'term': {'Cuisine': cuisine_alias}}]}},
+        'sort': [{'RestaurantID': 'asc'}]
+    }
+    if search_after:
+        query['search_after'] = search_after
+    return query
+
+# CATALOG SNAPSHOT
+def current_snapshot():
+    # None when there's no snapshot or it was built for another catalog
+    # version, and LF2 falls back to OpenSearch and DynamoDB
+    if not CATALOG_SNAPSHOT:
+        return None
+    try:
+        mtime = os.stat(CATALOG_SNAPSHOT).st_mtime
+    except OSError:
+        return None
+
+    if snapshot_state['mtime'] != mtime:
+        if snapshot_state['snapshot']:
+            snapshot_state['snapshot'].close()
+        snapshot_state.update(snapshot=None, mtime=mtime, candidates={}, geo={}, zips={})
+        try:
+            snapshot_state['snapshot'] = Snapshot(CATALOG_SNAPSHOT)
+            print(f"Mapped catalog snapshot {CATALOG_SNAPSHOT} ({snapshot_state['snapshot'].row_count} restaurants)")
+        except Exception as e:
+            print("Error opening the catalog snapshot:", str(e))
+
+    snapshot = snapshot_state['snapshot']
+    if snapshot is None:
+        return None
+    version = catalog_version()
+    if version is not None and snapshot.version != version:
+        print(f"Catalog snapshot is version {snapshot.version}, the catalog is {version}; not using it")
+        return None
+    return snapshot
+
+def snapshot_candidates(snapshot, cuisine_alias):
+    candidates = snapshot_state['candidates'].get(cuisine_alias)
+    if candidates is None:
+        candidates = []
+        for i in snapshot.rows(cuisine_alias):
+            row = snapshot.row(i)
+            candidates.append({
+                'id': row['Business ID'],
+                'row': i,
+                'weight': restaurant_weight(row['Rating'], row['Number of Reviews'])
+            })
+        snapshot_state['candidates'][cuisine_alias] = candidates
+    return candidates
+
+# CUISINE INDEX
+def index_slot_counts(aliases):
+    # Slot 0 of each cuisine holds how many dense slots follow it. The counts
+    # only change when the index is rebuilt, which bumps the catalog version.
+    version = catalog_version()
+    now = time.time()
+    counts = {}
+    for alias in aliases:
+        cached = index_counts.get(alias)
+        if cached and cached[0] == version and cached[1] > now:
+            counts[alias] = cached[2]
+
+    missing = [alias for alias in aliases if alias not in counts]
+    if missing:
+        keys = [{'Cuisine': alias, 'Slot': 0} for alias in missing]
+        for item in batch_get_items(RECOMMENDATION_INDEX_TABLE, keys):
+            counts[item['Cuisine']] = int(item['SlotCount'])
+        for alias in missing:
+            index_counts[alias] = (version, now + CANDIDATE_CACHE_TTL, counts.setdefault(alias, 0))
+    return counts
+
+def fetch_index_slots(wanted):
+    found = {}
+    # BatchGetItem takes at most 100 keys per call
+    for i in range(0, len(wanted), BATCH_GET_LIMIT):
+        keys = [{'Cuisine': alias, 'Slot': slot} for alias, slot in wanted[i:i + BATCH_GET_LIMIT]]
+        for item in batch_get_items(RECOMMENDATION_INDEX_TABLE, keys,
+                                    ProjectionExpression='Cuisine, Slot, #id, #name, Address',
+                                    ExpressionAttributeNames={'#id': 'Business ID', '#name': 'Name'}):
+            found[(item['Cuisine'], int(item['Slot']))] = item
+    return found
+
+# CUISINE CANDIDATE SETS
+def catalog_version():
+    # The offline loaders bump this item after every load. Checked at most
+    # once a minute; if it can't be read, cached sets just expire on TTL.
+    now = time.time()
+    if now - catalog_state['checked_at'] < CATALOG_VERSION_CHECK:
+        return catalog_state['version']
+    catalog_state['checked_at'] = now
+    table = dynamodb().Table(CANDIDATE_CACHE_TABLE)
+    try:
+        response = table.get_item(Key={'CacheKey': 'catalog-version'})
+        catalog_state['version'] = int(response['Item']['Version']) if 'Item' in response else None
+        catalog_state['missing_table'] = False
+    except table.meta.client.exceptions.ResourceNotFoundException:
+        # Deployments without the candidate cache may never create the table
+        if not catalog_state['missing_table']:
+            print(f"No {CANDIDATE_CACHE_TABLE} table, not checking the catalog version")
+        catalog_state['missing_table'] = True
+    except Exception as e:
+        print("Error reading catalog version:", str(e))
+    return catalog_state['version']
+
+def get_candidates(aliases):
+    version = catalog_version()
+    now = time.time()
+    found = {}
+
+    # Container memory first
+    for alias in aliases:
+        cached = candidate_cache.get(alias)
+        if cached and cached[0] == version and cached[1] > now:
+            found[alias] = cached[2]
+
+    # Then the shared tier
+    missing = [alias for alias in aliases if alias not in found]
+    if missing and CANDIDATE_CACHE in ('dynamodb', 'file'):
+        try:
+            for alias, (expires_at, candidates) in load_shared_candidates(missing, version).items():
+                candidate_cache[alias] = (version, expires_at, candidates)
+                found[alias] = candidates
+        except Exception as e:
+            print("Error reading shared candidate cache:", str(e))
+
+    # Then OpenSearch and DynamoDB for whatever is left
+    missing = [alias for alias in aliases if alias not in found]
+    if missing:
+        built = build_candidates(missing)
+        expires_at = now + CANDIDATE_CACHE_TTL
+        for alias, candidates in built.items():
+            candidate_cache[alias] = (version, expires_at, candidates)
+            found[alias] = candidates
+        if CANDIDATE_CACHE in ('dynamodb', 'file'):
+            try:
+                save_shared_candidates(built, version, expires_at)
+            except Exception as e:
+                print("Error writing shared candidate cache:", str(e))
+
+    print(f"Candidate sets: {len(aliases) - len(missing)} cached, {len(missing)} built (catalog version {version})")
+    return found
+
+def build_candidates(aliases):
+    # Every restaurant of each cuisine, so any of them can be picked, with
+    # the line the email shows so a pick needs no DynamoDB lookup. Pages are
+    # read with search_after, and cuisines with more pages to go share one
+    # _msearch per round.
+    built = {alias: [] for alias in aliases}
+    search_after = {alias: None for alias in aliases}
+    while search_after:
+        pending = list(search_after)
+        responses = msearch([build_candidate_query(alias, search_after[alias]) for alias in pending])
+        for alias, response in zip(pending, responses):
+            if 'error' in response:
+                raise Exception(f"search for {alias} failed: {response['error']}")
+            hits = response.get('hits', {}).get('hits', [])
+            built[alias].extend(
+                {
+                    'id': hit['_source']['RestaurantID'],
+                    'weight': restaurant_weight(hit['_source'].get('Rating'), hit['_source'].get('Number of Reviews'))
+                }
+                for hit in hits
+            )
+            if len(hits) < CANDIDATE_PAGE_SIZE:
+                del search_after[alias]
+            else:
+                search_after[alias] = hits[-1]['sort']
+
+    # Straight from the table: thousands of rows would only push the
+    # restaurants picked recently out of the restaurant cache
+    ids = list({c['id'] for candidates in built.values() for c in candidates})
+    texts = {}
+    for i in range(0, len(ids), BATCH_GET_LIMIT):
+        for item in batch_get_restaurants(ids[i:i + BATCH_GET_LIMIT]):
+            texts[item['Business ID']] = render_restaurant(item)
+    for alias, candidates in built.items():
+        built[alias] = [dict(c, text=texts[c['id']]) for c in candidates if c['id'] in texts]
+    return built
+
+def load_shared_candidates(aliases, version):
+    now = time.time()
+    if CANDIDATE_CACHE == 'dynamodb':
+        entries = load_candidate_items(aliases)
+    else:
+        if not os.path.exists(CANDIDATE_CACHE_FILE):
+            return {}
+        with open(CANDIDATE_CACHE_FILE, 'r') as file:
+            entries = json.load(file)
+
+    return {
+        alias: (entry['expires_at'], entry['candidates'])
+        for alias, entry in entries.items()
+        if alias in aliases and entry['version'] == version and entry['expires_at'] > now
+    }
+
+def load_candidate_items(aliases):
+    # cuisine#<alias> holds the first chunk and the chunk count, the rest
+    # are under cuisine#<alias>#<n>. Most cuisines fit in the first one.
+    def get(keys):
+        items = {}
+        for i in range(0, len(keys), BATCH_GET_LIMIT):
+            for item in batch_get_items(CANDIDATE_CACHE_TABLE, [{'CacheKey': key} for key in keys[i:i + BATCH_GET_LIMIT]]):
+                items[item['CacheKey']] = item
+        return items
+
+    heads = get([f"cuisine#{alias}" for alias in aliases])
+    rest = get([
+        f"cuisine#{alias}#{n}"
+        for alias in aliases if f"cuisine#{alias}" in heads
+        for n in range(1, int(heads[f"cuisine#{alias}"].get('Chunks', 1)))
+    ])
+
+    entries = {}
+    for alias in aliases:
+        head = heads.get(f"cuisine#{alias}")
+        if not head:
+            continue
+        chunks = [head] + [rest.get(f"cuisine#{alias}#{n}") for n in range(1, int(head.get('Chunks', 1)))]
+        # A chunk missing or left from another write makes the whole set a miss
+        if any(chunk is None or chunk['ExpiresAt'] != head['ExpiresAt'] for chunk in chunks):
+            continue
+        entries[alias] = {
+            'version': int(head['Version']) if head.get('Version') is not None else None,
+            'expires_at': float(head['ExpiresAt']),
+            'candidates': [c for chunk in chunks for c in json.loads(chunk['Candidates'])]
+        }
+    return entries
+
+def candidate_chunks(candidates):
+    chunks = [[]]
+    size = 0
+    for c in candidates:
+        length = len(json.dumps(c)) + 2
+        if chunks[-1] and size + length > CANDIDATE_CHUNK_BYTES:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(c)
+        size += length
+    return chunks
+
+def save_shared_candidates(built, version, expires_at):
+    if CANDIDATE_CACHE == 'dynamodb':
+        with dynamodb().Table(CANDIDATE_CACHE_TABLE).batch_writer() as batch:
+            for alias, candidates in built.items():
+                chunks = candidate_chunks(candidates)
+                for n, chunk in enumerate(chunks):
+                    item = {
+                        'CacheKey': f"cuisine#{alias}#{n}" if n else f"cuisine#{alias}",
+                        'Version': version,
+                        'ExpiresAt': int(expires_at),
+                        'Candidates': json.dumps(chunk)
+                    }
+                    if not n:
+                        item['Chunks'] = len(chunks)
+                    batch.put_item(Item=item)
+        return
+
+    entries = {}
+    if os.path.exists(CANDIDATE_CACHE_FILE):
+        with open(CANDIDATE_CACHE_FILE, 'r') as file:
+            entries = json.load(file)
+    for alias, candidates in built.items():
+        entries[alias] = {'version': version, 'expires_at': expires_at, 'candidates': candidates}
+    with open(CANDIDATE_CACHE_FILE + '.tmp', 'w') as file:
+        json.dump(entries, file)
+    os.replace(CANDIDATE_CACHE_FILE + '.tmp', CANDIDATE_CACHE_FILE)
+
+def restaurant_weight(rating, reviews):
+    # the same weighting as the random_score query
+    return max(float(rating or 3) * math.log10(2 + float(reviews or 1)), 0.01)
+
+def pick_weighted(candidates, exclude_ids, k):
+    # Weighted sampling without replacement: each candidate draws a random key
+    # scaled by its weight and the k largest keys win
+    def sample(pool, n):
+        return heapq.nlargest(n, pool, key=lambda c: random.random() ** (1.0 / c['weight']))
+
+    fresh = [c for c in candidates if c['id'] not in exclude_ids]
+    picks = sample(fresh, k)
+    if len(picks) < k:
+        # Allow repeats if the user has already seen most of the cuisine
+        picks += sample([c for c in candidates if c['id'] in exclude_ids], k - len(picks))
+    return picks
+
+# RECENTLY SENT RESTAURANTS
+def recent_restaurants(email):
+    cutoff = time.time() - RECENT_TTL
+    with recent_lock:
+        sent = [(sent_at, rid) for sent_at, rid in recently_sent.get(email, []) if sent_at > cutoff]
+        recently_sent[email] = sent
+    return [rid for _, rid in sent]
+
+def remember_sent(email, restaurant_ids):
+    now = time.time()
+    with recent_lock:
+        recently_sent.setdefault(email, []).extend((now, rid) for rid in restaurant_ids)
+
+# RESTAURANT DETAILS (cache + BatchGetItem)
+def fetch_restaurants(restaurant_ids):
+    now = time.time()
+    found = {}
+    missing = []
+
+    for restaurant_id in restaurant_ids:
+        cached = restaurant_cache.get(restaurant_id)
+        if cached and cached[0] > now:
+            restaurant_cache.move_to_end(restaurant_id)
+            found[restaurant_id] = cached[1]
+            cache_stats['hits'] += 1
+        else:
+            missing.append(restaurant_id)
+            cache_stats['misses'] += 1
+
+    # BatchGetItem takes at most 100 keys per call
+    for i in range(0, len(missing), BATCH_GET_LIMIT):
+        for item in batch_get_restaurants(missing[i:i + BATCH_GET_LIMIT]):
+            details = {'Name': item.get('Name'), 'Address': item.get('Address')}
+            found[item['Business ID']] = details
+            restaurant_cache[item['Business ID']] = (now + CACHE_TTL, details)
+            restaurant_cache.move_to_end(item['Business ID'])
+
+    while len(restaurant_cache) > CACHE_SIZE:
+        restaurant_cache.popitem(last=False)
+
+    print(f"Restaurant cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+    return found
+
+def batch_get_restaurants(restaurant_ids):
+    return batch_get_items(DYNAMODB_TABLE, [{'Business ID': rid} for rid in restaurant_ids],
+                           ProjectionExpression='#id, #name, #address',
+                           ExpressionAttributeNames={'#id': 'Business ID', '#name': 'Name', '#address': 'Address'})
+
+def batch_get_items(table_name, keys, **options):
+    request = {table_name: dict(options, Keys=keys)}
+    items = []
+    for attempt in range(BATCH_GET_RETRIES):
+        response = dynamodb().batch_get_item(RequestItems=request)
+        items.extend(response.get('Responses', {}).get(table_name, []))
+        request = response.get('UnprocessedKeys')
+        if not request:
+            return items
+        # Back off before retrying the keys DynamoDB didn't get to
+        time.sleep(0.05 * (2 ** attempt))
+    print(f"Gave up on {len(request[table_name]['Keys'])} unprocessed keys")
+    return items
 
 def send_email(recipient, cuisine, date, time, num_people, recommendations):
     if not recommendations:
@@ -114,7 +1172,7 @@ def send_email(recipient, cuisine, date, time, num_people, recommendations):
         text_body += "\nEnjoy your meal!"
         
     try:
-        ses.send_email(
+        ses().send_email(
             Source=SENDER_EMAIL,
             Destination={'ToAddresses': [recipient]},
             Message={
@@ -124,4 +1182,6 @@ def send_email(recipient, cuisine, date, time, num_people, recommendations):
         )
     except Exception as e:
         print("Error sending email:", str(e))
-        raise e
\ No newline at end of file
+        raise e
+
+metrics.init_done(_import_started)
@@ -0,0 +1,142 @@
+import mmap
+import os
+import struct
+import time
+
+# Compact read-only copy of the restaurant catalog that LF2 can sample from
+# without any network calls. The loaders write it (see bump_catalog_version in
+# other-scripts/upload_to_dynamodb.py) and it ships next to LF2 or in a layer
+# under /opt. Only the standard library is used so LF2 can mmap it as is.
+#
+# Layout, all little endian:
+#   header    magic, catalog version, row count, cuisine count, built at,
+#             strings size
+#   cuisines  one entry per cuisine: name, first row, row count
+#   rows      one fixed size entry per restaurant, grouped by cuisine
+#   strings   UTF-8 IDs, names, addresses, zip codes and cuisine names,
+#             referenced by (offset, length) from the two tables above
+
+MAGIC = b'DCS3'
+HEADER = struct.Struct('<4sIIIQI')
+CUISINE = struct.Struct('<IHII')
+ROW_FIELDS = [
+    ('id_offset', 'I'), ('id_length', 'H'),
+    ('name_offset', 'I'), ('name_length', 'H'),
+    ('address_offset', 'I'), ('address_length', 'H'),
+    ('zip_offset', 'I'), ('zip_length', 'H'),
+    ('rating', 'f'), ('latitude', 'f'), ('longitude', 'f'), ('reviews', 'I')
+]
+ROW = struct.Struct('<' + ''.join(code for _, code in ROW_FIELDS))
+NUMPY_TYPES = {'I': '<u4', 'H': '<u2', 'f': '<f4'}
+MAX_STRING = 0xFFFF
+
+def cuisine_of(r):
+    # Same cuisine as the OpenSearch documents: the first category alias
+    return r['categories'][0]['alias'] if r.get('categories') else 'unknown'
+
+def write_snapshot(restaurants, path, version):
+    groups = {}
+    for r in restaurants:
+        groups.setdefault(cuisine_of(r), []).append(r)
+
+    strings = bytearray()
+    def add_string(value):
+        data = str(value).encode('utf-8')[:MAX_STRING]
+        offset = len(strings)
+        strings.extend(data)
+        return offset, len(data)
+
+    cuisines = bytearray()
+    rows = bytearray()
+    row_count = 0
+    for cuisine, restaurants in sorted(groups.items()):
+        cuisines.extend(CUISINE.pack(*add_string(cuisine), row_count, len(restaurants)))
+        for r in restaurants:
+            coordinates = r.get('coordinates') or {}
+            rows.extend(ROW.pack(
+                *add_string(r['id']),
+                *add_string(r.get('name', 'Unknown')),
+                *add_string(", ".join(r.get('location', {}).get('display_address', []))),
+                *add_string(r.get('location', {}).get('zip_code') or ''),
+                float(r.get('rating') or 0),
+                float(coordinates.get('latitude') or 0),
+                float(coordinates.get('longitude') or 0),
+                int(r.get('review_count') or 0)
+            ))
+        row_count += len(restaurants)
+
+    with open(path + '.tmp', 'wb') as file:
+        file.write(HEADER.pack(MAGIC, version or 0, row_count, len(groups), int(time.time()), len(strings)))
+        file.write(cuisines)
+        file.write(rows)
+        file.write(strings)
+    os.replace(path + '.tmp', path)
+    return row_count
+
+class Snapshot:
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.load_tables(path)
+        except Exception:
+            self.data.close()
+            raise
+
+    def load_tables(self, path):
+        if len(self.data) < HEADER.size:
+            raise Exception(f"{path} is too short for a catalog snapshot ({len(self.data)} bytes)")
+        magic, self.version, self.row_count, cuisine_count, self.built_at, strings_size = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise Exception(f"{path} isn't a catalog snapshot")
+
+        self.rows_at = HEADER.size + cuisine_count * CUISINE.size
+        self.strings_at = self.rows_at + self.row_count * ROW.size
+        # A partly copied file would otherwise fail on some rows and not others
+        if len(self.data) != self.strings_at + strings_size:
+            raise Exception(f"{path} is {len(self.data)} bytes, its header says {self.strings_at + strings_size}")
+
+        # Cuisine -> range of row numbers
+        self.cuisines = {}
+        for i in range(cuisine_count):
+            name_offset, name_length, first, count = CUISINE.unpack_from(self.data, HEADER.size + i * CUISINE.size)
+            if first + count > self.row_count or name_offset + name_length > strings_size:
+                raise Exception(f"{path} has a cuisine entry outside the file")
+            self.cuisines[self.string(name_offset, name_length)] = range(first, first + count)
+
+    def string(self, offset, length):
+        start = self.strings_at + offset
+        return self.data[start:start + length].decode('utf-8')
+
+    def rows(self, cuisine):
+        return self.cuisines.get(cuisine, range(0))
+
+    def row(self, i):
+        row = dict(zip((name for name, _ in ROW_FIELDS), ROW.unpack_from(self.data, self.rows_at + i * ROW.size)))
+        return {
+            'Business ID': self.string(row['id_offset'], row['id_length']),
+            'Name': self.string(row['name_offset'], row['name_length']),
+            'Address': self.string(row['address_offset'], row['address_length']),
+            'Zip Code': self.string(row['zip_offset'], row['zip_length']),
+            'Rating': row['rating'],
+            'Latitude': row['latitude'],
+            'Longitude': row['longitude'],
+            'Number of Reviews': row['reviews']
+        }
+
+    def table(self):
+        # The rows as a NumPy structured array over the mapped file, no copy
+        import numpy as np
+        dtype = np.dtype([(name, NUMPY_TYPES[code]) for name, code in ROW_FIELDS])
+        return np.frombuffer(self.data, dtype=dtype, count=self.row_count, offset=self.rows_at)
+
+    def string_bytes(self):
+        import numpy as np
+        return np.frombuffer(self.data, dtype=np.uint8, offset=self.strings_at)
+
+    def close(self):
+        try:
+            self.data.close()
+        except BufferError:
+            # Still viewed by a table(), the map goes away with the last view
+            pass
@@ -0,0 +1,52 @@
+import os
+import threading
+import metrics
+
+# AWS clients shared by LF0, LF1 and LF2 (package this file with each function,
+# next to metrics.py). Nothing is imported from boto3 until a handler makes its
+# first AWS call, and each client is built once per container after that.
+# botocore only loads a service's model when its first client is built, so a
+# code path that never talks to a service never pays for loading it.
+
+_lock = threading.Lock()
+_session = {}
+_clients = {}
+_hooks = []
+
+def _boto3_session():
+    if 'session' not in _session:
+        import boto3
+        _session['session'] = boto3.session.Session(region_name=os.environ.get('AWS_REGION'))
+    return _session['session']
+
+def _built(client):
+    for hook in _hooks:
+        hook(client)
+    return metrics.instrument(client)
+
+def client(service, **config):
+    # Clients are thread safe, so LF2's worker threads can share them. Each
+    # config gets its own client, e.g. LF0's Lex clients per read timeout.
+    key = f"{service}:{sorted(config.items())!r}" if config else service
+    with _lock:
+        if key not in _clients:
+            kwargs = {}
+            if config:
+                from botocore.config import Config
+                kwargs['config'] = Config(**config)
+            _clients[key] = _built(_boto3_session().client(service, **kwargs))
+        return _clients[key]
+
+def resource(service):
+    # Resources aren't thread safe, only use them from the handler thread
+    key = f"{service}:resource"
+    with _lock:
+        if key not in _clients:
+            built = _boto3_session().resource(service)
+            _built(built.meta.client)
+            _clients[key] = built
+        return _clients[key]
+
+def on_create(hook):
+    # hook(client) is called for every client built from now on
+    _hooks.append(hook)
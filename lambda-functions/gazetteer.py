@@ -0,0 +1,213 @@
+import json
+import os
+import re
+import unicodedata
+
+# Cuisines and locations the catalog actually covers, shared by LF1 (slot
+# validation) and LF2 (cuisine name -> Yelp category alias). Package this file
+# with both functions, together with the gazetteer.json that
+# other-scripts/build_gazetteer.py generates from the scraped data. Without
+# the JSON the built-in table below is used, which matches the original scrape.
+#
+# gazetteer.json:
+#   cuisines   alias -> {'title', 'names': [...], 'restaurants'}
+#   locations  name -> {'names': [...], 'timezone', 'point': [lat, lon], 'within'}
+#
+# A location with 'within' is a neighborhood of that city. Its point is where
+# LF2 ranks restaurants from when a request names it, and the city's timezone
+# applies. Cities get the mean point of their restaurants.
+
+GAZETTEER_FILE = os.environ.get('GAZETTEER_FILE') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gazetteer.json')
+DEFAULT_TIMEZONE = os.environ.get('GAZETTEER_TIMEZONE') or 'America/New_York'
+
+BUILT_IN = {
+    'cuisines': {
+        'chinese': {'title': 'Chinese', 'names': ['chinese']},
+        'italian': {'title': 'Italian', 'names': ['italian']},
+        'japanese': {'title': 'Japanese', 'names': ['japanese']},
+        'mexican': {'title': 'Mexican', 'names': ['mexican']},
+        'indpak': {'title': 'Indian', 'names': ['indian', 'indpak']},
+        'thai': {'title': 'Thai', 'names': ['thai']}
+    },
+    'locations': {
+        'New York': {'names': ['new york', 'new york city', 'nyc', 'manhattan', 'ny'], 'timezone': DEFAULT_TIMEZONE},
+        # Approximate neighborhood centroids
+        'Battery Park City': {'point': [40.7115, -74.0156], 'within': 'New York'},
+        'Chelsea': {'point': [40.7465, -74.0014], 'within': 'New York'},
+        'Chinatown': {'point': [40.7158, -73.9970], 'within': 'New York'},
+        'East Harlem': {'point': [40.7957, -73.9389], 'within': 'New York'},
+        'East Village': {'point': [40.7265, -73.9815], 'within': 'New York'},
+        'Financial District': {'names': ['fidi'], 'point': [40.7075, -74.0113], 'within': 'New York'},
+        'Flatiron': {'names': ['flatiron district'], 'point': [40.7411, -73.9897], 'within': 'New York'},
+        'Gramercy': {'point': [40.7368, -73.9845], 'within': 'New York'},
+        'Greenwich Village': {'point': [40.7336, -74.0027], 'within': 'New York'},
+        'Harlem': {'point': [40.8116, -73.9465], 'within': 'New York'},
+        "Hell's Kitchen": {'point': [40.7638, -73.9918], 'within': 'New York'},
+        'Inwood': {'point': [40.8677, -73.9212], 'within': 'New York'},
+        'Kips Bay': {'point': [40.7420, -73.9800], 'within': 'New York'},
+        'Koreatown': {'point': [40.7477, -73.9869], 'within': 'New York'},
+        'Little Italy': {'point': [40.7191, -73.9973], 'within': 'New York'},
+        'Lower East Side': {'names': ['les'], 'point': [40.7150, -73.9843], 'within': 'New York'},
+        'Midtown': {'point': [40.7549, -73.9840], 'within': 'New York'},
+        'Morningside Heights': {'point': [40.8090, -73.9626], 'within': 'New York'},
+        'Murray Hill': {'point': [40.7479, -73.9757], 'within': 'New York'},
+        'NoHo': {'point': [40.7265, -73.9927], 'within': 'New York'},
+        'Nolita': {'point': [40.7233, -73.9955], 'within': 'New York'},
+        'SoHo': {'point': [40.7233, -74.0030], 'within': 'New York'},
+        'Times Square': {'point': [40.7580, -73.9855], 'within': 'New York'},
+        'Tribeca': {'point': [40.7163, -74.0086], 'within': 'New York'},
+        'Union Square': {'point': [40.7359, -73.9911], 'within': 'New York'},
+        'Upper East Side': {'names': ['ues'], 'point': [40.7736, -73.9566], 'within': 'New York'},
+        'Upper West Side': {'names': ['uws'], 'point': [40.7870, -73.9754], 'within': 'New York'},
+        'Washington Heights': {'point': [40.8417, -73.9394], 'within': 'New York'},
+        'West Village': {'point': [40.7358, -74.0036], 'within': 'New York'}
+    }
+}
+
+PUNCTUATION = re.compile(r"[^\w\s]")
+SPACES = re.compile(r"\s+")
+# "thai food", "italian cuisine", "mexican restaurants"
+FILLER = re.compile(r"\s+(food|cuisine|restaurants?|place|places)$")
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', str(text)).encode('ascii', 'ignore').decode('ascii')
+    text = SPACES.sub(' ', PUNCTUATION.sub(' ', text.lower().replace('&', ' and '))).strip()
+    return FILLER.sub('', text)
+
+class AliasTrie:
+    # Normalized name -> value, with lookups that forgive a typo or two
+    def __init__(self):
+        self.root = {}
+
+    def add(self, name, value):
+        node = self.root
+        for char in name:
+            node = node.setdefault(char, {})
+        node.setdefault(None, value)
+
+    def get(self, name):
+        node = self.root
+        for char in name:
+            node = node.get(char)
+            if node is None:
+                return None
+        return node.get(None)
+
+    def closest(self, name, max_distance):
+        # The one value within max_distance edits of name, or None when there
+        # is none or more than one. Levenshtein distance is computed along the
+        # trie, one row per node, so branches already too far away are never
+        # walked.
+        found = set()
+        first_row = list(range(len(name) + 1))
+        stack = [(node, char, first_row) for char, node in self.root.items() if char is not None]
+        while stack:
+            node, char, previous = stack.pop()
+            row = [previous[0] + 1]
+            for i in range(1, len(name) + 1):
+                row.append(min(row[i - 1] + 1, previous[i] + 1, previous[i - 1] + (name[i - 1] != char)))
+            if node.get(None) is not None and row[-1] <= max_distance:
+                found.add(node[None])
+            if min(row) <= max_distance:
+                stack.extend((child, c, row) for c, child in node.items() if c is not None)
+        return found.pop() if len(found) == 1 else None
+
+    def containing(self, words):
+        # Every value with a name that has these whole words in it
+        found = set()
+        stack = [(self.root, '')]
+        while stack:
+            node, prefix = stack.pop()
+            if node.get(None) is not None and f" {words} " in f" {prefix} ":
+                found.add(node[None])
+            stack.extend((child, prefix + c) for c, child in node.items() if c is not None)
+        return found
+
+def max_typos(name):
+    # One slip in a longer name; short names are too close to each other
+    # ("chai" and "thai") to guess
+    return 1 if len(name) >= 6 else 0
+
+_state = {}
+
+def load():
+    # Once per container
+    if 'cuisines' in _state:
+        return _state
+
+    data = BUILT_IN
+    if os.path.exists(GAZETTEER_FILE):
+        with open(GAZETTEER_FILE, 'r') as file:
+            data = json.load(file)
+
+    cuisines = AliasTrie()
+    for alias, entry in data['cuisines'].items():
+        for name in [alias, entry.get('title', alias)] + entry.get('names', []):
+            cuisines.add(normalize(name), alias)
+    locations = AliasTrie()
+    for location, entry in data['locations'].items():
+        for name in [location] + entry.get('names', []):
+            locations.add(normalize(name), location)
+
+    # Most restaurants first, for "try one of ..." suggestions
+    ranked = sorted(data['cuisines'].items(), key=lambda item: (-item[1].get('restaurants', 0), item[0]))
+    cities = {location: entry.get('within') or location for location, entry in data['locations'].items()}
+    _state.update(
+        cuisines=cuisines,
+        locations=locations,
+        cuisine_aliases=frozenset(data['cuisines']),
+        location_names=frozenset(location for location, city in cities.items() if location == city),
+        titles={alias: entry.get('title', alias) for alias, entry in data['cuisines'].items()},
+        popular=[entry.get('title', alias) for alias, entry in ranked],
+        cities=cities,
+        points={location: tuple(entry['point']) for location, entry in data['locations'].items() if entry.get('point')},
+        timezones={
+            location: entry.get('timezone') or data['locations'].get(cities[location], {}).get('timezone') or DEFAULT_TIMEZONE
+            for location, entry in data['locations'].items()
+        }
+    )
+    return _state
+
+def lookup(trie, text):
+    name = normalize(text)
+    if not name:
+        return None
+    return trie.get(name) or trie.closest(name, max_typos(name))
+
+def match_cuisine(text):
+    # Yelp category alias for what the user said, e.g. "Indian" -> "indpak"
+    return lookup(load()['cuisines'], text)
+
+def similar_cuisines(text):
+    # Titles to offer when text didn't match, e.g. "american" -> American
+    # (New) and American (Traditional)
+    name = normalize(text)
+    if not name:
+        return []
+    return sorted(cuisine_title(alias) for alias in load()['cuisines'].containing(name))
+
+def match_location(text):
+    return lookup(load()['locations'], text)
+
+def cuisine_title(alias):
+    return load()['titles'].get(alias, alias)
+
+def popular_cuisines(n):
+    return load()['popular'][:n]
+
+def location_names():
+    # Cities only, neighborhoods are found through them
+    return sorted(load()['location_names'])
+
+def location_city(location):
+    return load()['cities'].get(location, location)
+
+def is_neighborhood(location):
+    return location_city(location) != location
+
+def location_point(location):
+    # (lat, lon) to rank restaurants from, or None
+    return load()['points'].get(location)
+
+def location_timezone(location):
+    return load()['timezones'].get(location, DEFAULT_TIMEZONE)
@@ -0,0 +1,97 @@
+import json
+import os
+import time
+import threading
+import uuid
+from contextlib import contextmanager
+
+# Timing and metrics shared by LF0, LF1 and LF2 (package this file with each
+# function). Everything is written to the log as CloudWatch Embedded Metric
+# Format, so CloudWatch turns the JSON lines into metrics without any API calls.
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'DiningConcierge')
+
+_lock = threading.Lock()
+_timings = {}
+_counts = {}
+_cold_start = {'ms': None, 'reported': False}
+
+def new_correlation_id():
+    return str(uuid.uuid4())
+
+def record(name, ms):
+    with _lock:
+        _timings.setdefault(name, []).append(round(ms, 2))
+
+def count(name, value=1):
+    with _lock:
+        _counts[name] = _counts.get(name, 0) + value
+
+@contextmanager
+def timer(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, (time.perf_counter() - start) * 1000)
+
+def instrument(client):
+    # Times every API call the boto3 client makes, named service.Operation.
+    # Calls that raise (timeouts, connection errors) are timed too and counted
+    # as service.Operation.Errors.
+    def before_call(model, context, **kwargs):
+        context['metrics_operation'] = f"{model.service_model.service_name}.{model.name}"
+        context['metrics_started'] = time.perf_counter()
+
+    def after_call(context, **kwargs):
+        started = context.get('metrics_started')
+        if started is not None:
+            record(context['metrics_operation'], (time.perf_counter() - started) * 1000)
+
+    def after_call_error(context, **kwargs):
+        # botocore only passes the exception and the context here
+        after_call(context)
+        if context.get('metrics_operation'):
+            count(f"{context['metrics_operation']}.Errors")
+
+    client.meta.events.register('before-call.*.*', before_call)
+    client.meta.events.register('after-call.*.*', after_call)
+    client.meta.events.register('after-call-error.*.*', after_call_error)
+    return client
+
+def init_done(started):
+    # Called at the end of module import with the time the import began
+    _cold_start['ms'] = (time.perf_counter() - started) * 1000
+
+def emit(function, values, unit='Milliseconds', **properties):
+    if not values:
+        return
+    document = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [['Function']],
+                'Metrics': [{'Name': name, 'Unit': unit} for name in values]
+            }]
+        },
+        'Function': function
+    }
+    document.update({k: v for k, v in properties.items() if v is not None})
+    document.update(values)
+    print(json.dumps(document))
+
+def flush(function, correlation_id=None, **properties):
+    # Writes everything recorded since the last flush
+    with _lock:
+        timings = dict(_timings)
+        counts = dict(_counts)
+        _timings.clear()
+        _counts.clear()
+
+    if _cold_start['ms'] is not None and not _cold_start['reported']:
+        timings['ColdStartInit'] = [round(_cold_start['ms'], 2)]
+        _cold_start['reported'] = True
+
+    emit(function, timings, CorrelationId=correlation_id, **properties)
+    emit(function, counts, unit='Count', CorrelationId=correlation_id, **properties)
@@ -0,0 +1,127 @@
+import numpy as np
+
+# Nearest-restaurant ranking over the catalog snapshot, used by LF2 when a
+# request names a neighborhood, zip code or lat/lon. Needs NumPy (a layer in
+# Lambda), so LF2 only imports this module once such a request arrives.
+#
+# Each cuisine's restaurants are bucketed into a lat/lon grid. A request only
+# scores the cells around it, and every request for the same cuisine in a
+# batch is scored in one vectorized haversine pass.
+
+EARTH_RADIUS_KM = 6371.0
+GRID_DEGREES = 0.01  # about 1.1 km north to south
+MAX_RINGS = 25
+# Excluded restaurants sort after every other candidate but can still fill in
+EXCLUDED_PENALTY = 2.0
+
+def cell_keys(lat, lon):
+    ix = np.floor(np.asarray(lat, dtype=np.float64) / GRID_DEGREES).astype(np.int64)
+    iy = np.floor(np.asarray(lon, dtype=np.float64) / GRID_DEGREES).astype(np.int64)
+    return ix * 100000 + iy
+
+def fixed_width(strings, offsets, lengths):
+    # Snapshot strings as one fixed width bytes array, so they compare in bulk
+    offsets = offsets.astype(np.int64)
+    lengths = lengths.astype(np.int64)
+    width = max(int(lengths.max()) if len(lengths) else 0, 1)
+    columns = np.arange(width)
+    characters = strings[np.minimum(offsets[:, None] + columns, len(strings) - 1)]
+    characters[columns >= lengths[:, None]] = 0
+    return np.ascontiguousarray(characters).view(f'S{width}').ravel()
+
+class GeoIndex:
+    def __init__(self, table, rows, strings):
+        # strings is the snapshot's string section as uint8
+        part = table[rows.start:rows.stop]
+        # Restaurants without coordinates can't be ranked by distance
+        located = (part['latitude'] != 0) | (part['longitude'] != 0)
+        lat = part['latitude'][located].astype(np.float64)
+        lon = part['longitude'][located].astype(np.float64)
+
+        # Sort by cell so every cell is a contiguous slice of the arrays
+        cells = cell_keys(lat, lon)
+        order = np.argsort(cells, kind='stable')
+        self.rows = np.arange(rows.start, rows.stop)[located][order]
+        self.lat = np.radians(lat[order])
+        self.lon = np.radians(lon[order])
+        self.rating = part['rating'][located][order].astype(np.float64)
+        self.ids = fixed_width(strings, part['id_offset'][located][order], part['id_length'][located][order])
+
+        keys, starts, counts = np.unique(cells[order], return_index=True, return_counts=True)
+        self.cells = {int(key): (int(start), int(start + count)) for key, start, count in zip(keys, starts, counts)}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def nearby(self, lat, lon, pool):
+        # Positions in the grid rings around the point, out to one ring past
+        # the first that brings the total to pool
+        ix = int(np.floor(lat / GRID_DEGREES))
+        iy = int(np.floor(lon / GRID_DEGREES))
+        spans = []
+        total = 0
+        last_ring = MAX_RINGS
+        for ring in range(MAX_RINGS + 1):
+            for dx in range(-ring, ring + 1):
+                for dy in (range(-ring, ring + 1) if abs(dx) == ring else (-ring, ring)):
+                    span = self.cells.get((ix + dx) * 100000 + iy + dy)
+                    if span:
+                        spans.append(span)
+                        total += span[1] - span[0]
+            if total >= pool and last_ring == MAX_RINGS:
+                last_ring = ring + 1
+            if ring >= last_ring:
+                break
+
+        if not spans:
+            # Nothing near the point, rank the whole cuisine
+            return np.arange(len(self.rows))
+        return np.concatenate([np.arange(start, end) for start, end in spans])
+
+    def excluded(self, positions, restaurant_ids):
+        # Which positions hold one of these restaurant IDs
+        width = self.ids.dtype.itemsize
+        wanted = [rid.encode('utf-8') for rid in restaurant_ids]
+        wanted = np.array([rid for rid in wanted if len(rid) <= width], dtype=self.ids.dtype)
+        return np.isin(self.ids[positions], wanted)
+
+    def top_k(self, candidates, points, k, excluded=None, rating_weight=0.3, scale_km=1.0):
+        # candidates[i] holds the positions to score for points[i]. All the
+        # (request, candidate) pairs are scored in one pass, and each request
+        # gets the snapshot rows of its best k and their distances in km.
+        counts = np.array([len(c) for c in candidates], dtype=np.int64)
+        positions = np.concatenate(candidates).astype(np.int64)
+        owner = np.repeat(np.arange(len(points)), counts)
+
+        points = np.radians(np.asarray(points, dtype=np.float64))
+        lat1, lon1 = points[owner, 0], points[owner, 1]
+        lat2, lon2 = self.lat[positions], self.lon[positions]
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+        scores = (1 - rating_weight) * np.exp(-distances / scale_km) + rating_weight * self.rating[positions] / 5
+        if excluded is not None:
+            flags = [np.zeros(n, dtype=bool) if e is None else np.asarray(e, dtype=bool) for e, n in zip(excluded, counts)]
+            scores -= EXCLUDED_PENALTY * np.concatenate(flags)
+
+        # Best first within each request, then keep the first k of each
+        order = np.lexsort((-scores, owner))
+        starts = np.cumsum(counts) - counts
+        keep = order[np.arange(len(order)) - np.repeat(starts, counts) < k]
+
+        splits = np.cumsum(np.minimum(counts, k))[:-1]
+        return list(zip(np.split(self.rows[positions[keep]], splits), np.split(distances[keep], splits)))
+
+def zip_centroid(table, strings, zip_code):
+    # Mean lat/lon of the restaurants in a zip code, or None. strings is the
+    # snapshot's string section as uint8, so the match runs over every row at once.
+    wanted = np.frombuffer(zip_code.encode('utf-8'), dtype=np.uint8)
+    matches = np.flatnonzero(table['zip_length'] == len(wanted))
+    if len(wanted) == 0 or len(matches) == 0:
+        return None
+    characters = strings[table['zip_offset'][matches].astype(np.int64)[:, None] + np.arange(len(wanted))]
+    rows = table[matches[(characters == wanted).all(axis=1)]]
+    rows = rows[(rows['latitude'] != 0) | (rows['longitude'] != 0)]
+    if len(rows) == 0:
+        return None
+    return float(rows['latitude'].mean()), float(rows['longitude'].mean())
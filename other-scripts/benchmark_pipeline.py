@@ -0,0 +1,343 @@
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Runs LF0 -> Lex -> LF1 -> SQS -> LF2 in one process against local stand-ins:
+# moto for DynamoDB/SQS/SES, a fake Lex that calls LF1 the way Lex code hooks
+# do, and a fake OpenSearch HTTP server with configurable latency.
+#
+#   pip install moto
+#   python benchmark_pipeline.py --users 200 --opensearch-latency-ms 15
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-functions')
+
+CUISINES = {'chinese': 'chinese', 'italian': 'italian', 'japanese': 'japanese', 'mexican': 'mexican', 'indian': 'indpak', 'thai': 'thai'}
+# How popular each cuisine is in the synthetic workload
+CUISINE_WEIGHTS = [25, 20, 15, 15, 15, 10]
+SENDER = 'bench@example.com'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the chatbot pipeline with local AWS stand-ins.')
+    parser.add_argument('--users', type=int, default=100, help='number of synthetic users')
+    parser.add_argument('--restaurants', type=int, default=200, help='restaurants per cuisine')
+    parser.add_argument('--opensearch-latency-ms', type=float, default=10, help='added to every OpenSearch request')
+    parser.add_argument('--aws-latency-ms', type=float, default=0, help='added to every AWS API call')
+    parser.add_argument('--seed', type=int, default=7)
+    return parser.parse_args()
+
+# STATS
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, ms):
+        with self.lock:
+            self.samples.setdefault(stage, []).append(ms)
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+def timed(recorder, stage, fn, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        recorder.add(stage, (time.perf_counter() - start) * 1000)
+
+# FAKE OPENSEARCH
+def make_catalog(restaurants_per_cuisine, rng):
+    catalog = {}
+    for alias in CUISINES.values():
+        catalog[alias] = [
+            {
+                'RestaurantID': f"{alias}-{i}",
+                'Cuisine': alias,
+                'Rating': rng.choice([3.0, 3.5, 4.0, 4.5, 5.0]),
+                'Number of Reviews': rng.randint(1, 3000)
+            }
+            for i in range(restaurants_per_cuisine)
+        ]
+    return catalog
+
+def find_cuisine(query):
+    # Works for the term, match and function_score queries LF2 builds
+    if isinstance(query, dict):
+        for key, value in query.items():
+            if key in ('term', 'match') and isinstance(value, dict) and 'Cuisine' in value:
+                return value['Cuisine']
+            found = find_cuisine(value)
+            if found:
+                return found
+    elif isinstance(query, list):
+        for value in query:
+            found = find_cuisine(value)
+            if found:
+                return found
+    return None
+
+def find_excluded(query):
+    # The IDs in a must_not ids clause, if any
+    if isinstance(query, dict):
+        if 'ids' in query:
+            return set(query['ids'].get('values', []))
+        return set().union(*(find_excluded(value) for value in query.values()))
+    if isinstance(query, list):
+        return set().union(*(find_excluded(value) for value in query))
+    return set()
+
+def start_opensearch(catalog, latency_ms, recorder):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+            time.sleep(latency_ms / 1000)
+            recorder.count('opensearch.' + self.path.rsplit('/', 1)[-1])
+
+            if not self.path.endswith('/_msearch'):
+                self.send_response(404)
+                self.end_headers()
+                return
+
+            lines = [line for line in body.split('\n') if line.strip()]
+            responses = []
+            for search in (json.loads(line) for line in lines[1::2]):
+                excluded = find_excluded(search.get('query'))
+                docs = [doc for doc in catalog.get(find_cuisine(search.get('query')), []) if doc['RestaurantID'] not in excluded]
+                if search.get('sort'):
+                    # Candidate set pages: RestaurantID order, after the last page
+                    after = (search.get('search_after') or [''])[0]
+                    hits = sorted((doc for doc in docs if doc['RestaurantID'] > after), key=lambda doc: doc['RestaurantID'])[:search.get('size', 10)]
+                else:
+                    hits = random.sample(docs, min(search.get('size', 10), len(docs)))
+                fields = search.get('_source')
+                responses.append({'hits': {'hits': [
+                    {'_id': doc['RestaurantID'], 'sort': [doc['RestaurantID']],
+                     '_source': {k: v for k, v in doc.items() if not fields or k in fields}}
+                    for doc in hits
+                ]}})
+
+            payload = json.dumps({'responses': responses}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# AWS STAND-INS
+def setup_aws(catalog):
+    import boto3
+    boto3.client('ses').verify_email_identity(EmailAddress=SENDER)
+    queue_url = boto3.client('sqs').create_queue(QueueName='dining-requests')['QueueUrl']
+
+    dynamodb = boto3.resource('dynamodb')
+    for name, key in (('yelp-restaurants', 'Business ID'), ('UserHistory', 'Email'), ('RecommendationCache', 'CacheKey')):
+        dynamodb.create_table(
+            TableName=name,
+            KeySchema=[{'AttributeName': key, 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': key, 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+    with dynamodb.Table('yelp-restaurants').batch_writer() as batch:
+        for docs in catalog.values():
+            for doc in docs:
+                batch.put_item(Item={
+                    'Business ID': doc['RestaurantID'],
+                    'Name': f"Restaurant {doc['RestaurantID']}",
+                    'Address': f"{random.randint(1, 999)} Broadway, New York, NY 10001"
+                })
+    return queue_url
+
+def instrument(client, recorder, latency_ms):
+    # Count every AWS call by service and operation, and optionally slow it down
+    def before_call(model, **kwargs):
+        recorder.count(f"{model.service_model.service_name}.{model.name}")
+        if latency_ms:
+            time.sleep(latency_ms / 1000)
+    client.meta.events.register('before-call.*.*', before_call)
+
+class FakeLex:
+    # Stands in for lexv2-runtime: looks up the intent for each scripted
+    # utterance and calls LF1 the way Lex calls its code hooks
+    def __init__(self, lf1, recorder):
+        self.lf1 = lf1
+        self.recorder = recorder
+        self.script = {}
+
+    def recognize_text(self, botId, botAliasId, localeId, sessionId, text, sessionState):
+        self.recorder.count('lexv2-runtime.RecognizeText')
+        intent, slots = self.script[text]
+        event = {
+            'sessionState': {
+                'intent': {'name': intent, 'slots': slots},
+                'sessionAttributes': dict(sessionState.get('sessionAttributes', {}))
+            }
+        }
+
+        hooks = ['DialogCodeHook', 'FulfillmentCodeHook'] if intent in ('DiningSuggestionsIntent', 'RepeatSearchIntent') else ['FulfillmentCodeHook']
+        response = {}
+        for hook in hooks:
+            event['invocationSource'] = hook
+            response = timed(self.recorder, 'lf1', self.lf1.lambda_handler, event, None)
+            if response['sessionState']['dialogAction']['type'] in ('Close', 'ElicitSlot'):
+                break
+        return {'sessionId': sessionId, 'messages': response.get('messages', [])}
+
+# WORKLOAD
+def slot(value, original=None):
+    return {'value': {'interpretedValue': value, 'originalValue': original or value}}
+
+def build_workload(users, rng, lex):
+    # Each conversation is a list of (email, utterance) turns
+    tomorrow = str(datetime.date.today() + datetime.timedelta(days=1))
+    conversations = []
+    for n in range(users):
+        email = f"user{n}@example.com"
+        cuisine = rng.choices(list(CUISINES), weights=CUISINE_WEIGHTS)[0]
+        turns = []
+
+        def say(text, intent, slots=None):
+            text = f"{text} [{email} {len(turns)}]"
+            lex.script[text] = (intent, slots or {})
+            turns.append((email, text))
+
+        if rng.random() < 0.7:
+            say("hello", 'GreetingIntent')
+        say(f"I want {cuisine} food", 'DiningSuggestionsIntent', {
+            'Location': slot('manhattan'),
+            'Cuisine': slot(cuisine),
+            'DiningDate': slot(tomorrow),
+            'DiningTime': slot('19:00', '7 pm'),
+            'NumberOfPeople': slot(str(rng.randint(1, 8))),
+            'Email': slot(email)
+        })
+        if rng.random() < 0.2:
+            say("same as last time", 'RepeatSearchIntent', {
+                'DiningDate': slot(tomorrow),
+                'DiningTime': slot('20:00', '8 pm'),
+                'NumberOfPeople': slot('2')
+            })
+        if rng.random() < 0.5:
+            # Usually answered by LF0 without Lex
+            turns.append((email, "thanks!"))
+        conversations.append(turns)
+    return conversations
+
+def run_chat(lf0, conversations, recorder):
+    start = time.perf_counter()
+    turns = 0
+    for conversation in conversations:
+        for email, text in conversation:
+            body = json.dumps({'userEmail': email, 'messages': [{'type': 'unstructured', 'unstructured': {'text': text}}]})
+            response = timed(recorder, 'lf0', lf0.lambda_handler, {'body': body}, None)
+            if response['statusCode'] != 200:
+                print(f"LF0 failed on {text!r}: {response['body']}")
+            turns += 1
+    return turns, time.perf_counter() - start
+
+class Context:
+    def __init__(self, timeout_ms):
+        self.deadline = time.time() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.time()) * 1000)
+
+def run_recommendations(lf2, recorder):
+    processed = 0
+    busy = 0.0
+    while True:
+        start = time.perf_counter()
+        summary = lf2.lambda_handler({}, Context(60000))
+        if not summary:
+            break
+        busy += time.perf_counter() - start
+        recorder.add('lf2.batch', summary['batch_ms'])
+        for message in summary['messages']:
+            for stage, ms in message['timings_ms'].items():
+                recorder.add(f"lf2.{stage}", ms)
+        processed += summary['processed']
+    return processed, busy
+
+# REPORT
+def report(recorder, turns, chat_seconds, recommendations, lf2_seconds):
+    print()
+    print(f"Chat:            {turns} turns in {chat_seconds:.2f}s ({turns / max(chat_seconds, 1e-9):.1f} turns/s)")
+    print(f"Recommendations: {recommendations} emails in {lf2_seconds:.2f}s ({recommendations / max(lf2_seconds, 1e-9):.1f} msgs/s)")
+    print()
+    print(f"{'stage':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage in sorted(recorder.samples):
+        values = recorder.samples[stage]
+        print(f"{stage:<16}{len(values):>8}{percentile(values, 50):>10.2f}{percentile(values, 95):>10.2f}{percentile(values, 99):>10.2f}")
+    print()
+    print(f"{'call':<40}{'total':>8}{'per email':>12}")
+    for name in sorted(recorder.calls):
+        total = recorder.calls[name]
+        print(f"{name:<40}{total:>8}{total / max(recommendations, 1):>12.2f}")
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    recorder = Recorder()
+
+    catalog = make_catalog(args.restaurants, rng)
+    server = start_opensearch(catalog, args.opensearch_latency_ms, recorder)
+
+    os.environ.update({
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_REGION': 'us-east-1',
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'LEX_BOT_ID': 'BENCHBOT01',
+        'LEX_BOT_ALIAS_ID': 'BENCHALIAS',
+        'OPENSEARCH_HOST': f"http://127.0.0.1:{server.server_address[1]}",
+        'OPENSEARCH_USERNAME': 'benchmark',
+        'OPENSEARCH_PASSWORD': 'benchmark',
+        'SENDER_EMAIL': SENDER,
+        # Call LF2 once per batch and stop when the queue is empty
+        'DRAIN_QUEUE': 'false'
+    })
+
+    from moto import mock_aws
+    with mock_aws():
+        os.environ['SQS_QUEUE_URL'] = setup_aws(catalog)
+
+        sys.path.insert(0, LAMBDA_DIR)
+        import clients
+        import LF0
+        import LF1
+        import LF2
+
+        lex = FakeLex(LF1, recorder)
+        LF0.lex_client = lambda *args: lex
+        # The handlers build their clients on first use, all through clients.py
+        clients.on_create(lambda client: instrument(client, recorder, args.aws_latency_ms))
+
+        conversations = build_workload(args.users, rng, lex)
+        turns, chat_seconds = run_chat(LF0, conversations, recorder)
+        recommendations, lf2_seconds = run_recommendations(LF2, recorder)
+
+    server.shutdown()
+    report(recorder, turns, chat_seconds, recommendations, lf2_seconds)
+
+if __name__ == '__main__':
+    main()
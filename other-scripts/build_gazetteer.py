@@ -0,0 +1,125 @@
+import json
+import os
+import sys
+from dotenv import load_dotenv
+from yelp_data import read_restaurants
+
+load_dotenv()
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-functions'))
+from catalog_snapshot import cuisine_of
+from gazetteer import BUILT_IN, DEFAULT_TIMEZONE, normalize
+
+# Writes the gazetteer.json that LF1 and LF2 load through gazetteer.py: every
+# cuisine and city in the scraped data, so LF1 accepts what the catalog can
+# actually recommend. Run it after each scrape and package the file with both
+# functions.
+GAZETTEER_FILE = os.environ.get('GAZETTEER_FILE') or os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-functions', 'gazetteer.json')
+SEARCH_LOCATIONS = [l.strip() for l in os.environ.get('YELP_LOCATIONS', 'Manhattan').split(',') if l.strip()]
+# "City=Area/Zone,..." for cities in the other half of a state split between
+# timezones, e.g. "El Paso=America/Denver"
+CITY_TIMEZONES = dict(
+    pair.split('=', 1) for pair in (p.strip() for p in os.environ.get('GAZETTEER_CITY_TIMEZONES', '').split(',')) if '=' in pair
+)
+
+# The timezone of most of each US state, from Yelp's location.state
+STATE_TIMEZONES = {
+    'AL': 'America/Chicago', 'AK': 'America/Anchorage', 'AZ': 'America/Phoenix', 'AR': 'America/Chicago',
+    'CA': 'America/Los_Angeles', 'CO': 'America/Denver', 'CT': 'America/New_York', 'DC': 'America/New_York',
+    'DE': 'America/New_York', 'FL': 'America/New_York', 'GA': 'America/New_York', 'HI': 'Pacific/Honolulu',
+    'ID': 'America/Boise', 'IL': 'America/Chicago', 'IN': 'America/Indiana/Indianapolis', 'IA': 'America/Chicago',
+    'KS': 'America/Chicago', 'KY': 'America/New_York', 'LA': 'America/Chicago', 'ME': 'America/New_York',
+    'MD': 'America/New_York', 'MA': 'America/New_York', 'MI': 'America/Detroit', 'MN': 'America/Chicago',
+    'MS': 'America/Chicago', 'MO': 'America/Chicago', 'MT': 'America/Denver', 'NE': 'America/Chicago',
+    'NV': 'America/Los_Angeles', 'NH': 'America/New_York', 'NJ': 'America/New_York', 'NM': 'America/Denver',
+    'NY': 'America/New_York', 'NC': 'America/New_York', 'ND': 'America/Chicago', 'OH': 'America/New_York',
+    'OK': 'America/Chicago', 'OR': 'America/Los_Angeles', 'PA': 'America/New_York', 'PR': 'America/Puerto_Rico',
+    'RI': 'America/New_York', 'SC': 'America/New_York', 'SD': 'America/Chicago', 'TN': 'America/Chicago',
+    'TX': 'America/Chicago', 'UT': 'America/Denver', 'VT': 'America/New_York', 'VA': 'America/New_York',
+    'WA': 'America/Los_Angeles', 'WV': 'America/New_York', 'WI': 'America/Chicago', 'WY': 'America/Denver'
+}
+
+def build_cuisines(restaurants):
+    cuisines = {}
+    for r in restaurants:
+        if not r.get('categories'):
+            continue
+        alias = cuisine_of(r)
+        entry = cuisines.setdefault(alias, {'title': r['categories'][0].get('title') or alias, 'names': [], 'restaurants': 0})
+        entry['restaurants'] += 1
+
+    for alias, entry in cuisines.items():
+        # Yelp aliases look like "hotdogs" or "latin_american", also accept
+        # the spelled out title and anything the built-in table knows
+        names = {alias.replace('_', ' ').replace('-', ' '), entry['title'].lower()}
+        names.update(BUILT_IN['cuisines'].get(alias, {}).get('names', []))
+        entry['names'] = sorted(names)
+    return cuisines
+
+def build_locations(restaurants):
+    locations = json.loads(json.dumps(BUILT_IN['locations']))
+    known = {normalize(name): location for location, entry in locations.items() for name in [location] + entry.get('names', [])}
+
+    # City -> restaurant count, {state: count}, and [located count, latitude
+    # sum, longitude sum]
+    cities = {}
+    states = {}
+    sums = {}
+    for r in restaurants:
+        city = (r.get('location') or {}).get('city')
+        if not city:
+            continue
+        cities[city] = cities.get(city, 0) + 1
+        state = r['location'].get('state')
+        if state:
+            states.setdefault(city, {})[state] = states.get(city, {}).get(state, 0) + 1
+        coordinates = r.get('coordinates') or {}
+        if coordinates.get('latitude') and coordinates.get('longitude'):
+            total = sums.setdefault(city, [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += coordinates['latitude']
+            total[2] += coordinates['longitude']
+
+    # Cities with restaurants, then the areas the scraper searched
+    for name in sorted(cities, key=lambda city: -cities[city]) + SEARCH_LOCATIONS:
+        location = known.get(normalize(name))
+        if location is None:
+            location = name
+            locations[name] = {'names': [name], 'timezone': DEFAULT_TIMEZONE}
+            known[normalize(name)] = name
+        entry = locations[location]
+        if entry.get('within'):
+            continue
+        # Where LF2 ranks from when a request names the city as its area
+        if name in sums and not entry.get('point'):
+            count, latitude, longitude = sums[name]
+            entry['point'] = [round(latitude / count, 4), round(longitude / count, 4)]
+        # LF1 checks dates and times against the clock there
+        timezone = city_timezone(name, states.get(name))
+        if timezone:
+            entry['timezone'] = timezone
+    return locations
+
+def city_timezone(city, states):
+    # None leaves the timezone the location already has
+    if city in CITY_TIMEZONES:
+        return CITY_TIMEZONES[city]
+    if not states:
+        return None
+    state = max(states, key=states.get)
+    if state not in STATE_TIMEZONES:
+        print(f"No timezone for {city}, {state}; set it in GAZETTEER_CITY_TIMEZONES")
+        return None
+    return STATE_TIMEZONES[state]
+
+def build_gazetteer():
+    restaurants = list(read_restaurants(follow=False))
+    gazetteer = {'cuisines': build_cuisines(restaurants), 'locations': build_locations(restaurants)}
+
+    with open(GAZETTEER_FILE + '.tmp', 'w') as file:
+        json.dump(gazetteer, file, indent=2, sort_keys=True)
+    os.replace(GAZETTEER_FILE + '.tmp', GAZETTEER_FILE)
+    print(f"Wrote {len(gazetteer['cuisines'])} cuisines and {len(gazetteer['locations'])} locations to {GAZETTEER_FILE}.")
+
+if __name__ == '__main__':
+    build_gazetteer()
@@ -0,0 +1,119 @@
+import os
+from botocore.exceptions import ClientError
+from dotenv import load_dotenv
+from yelp_data import read_restaurants
+from upload_to_dynamodb import put_request, write_all, get_dynamodb, bump_catalog_version, float_to_decimal, BATCH_SIZE
+
+load_dotenv()
+
+# Cuisine-partitioned copy of the catalog for LF2's SEARCH_MODE=index. Run it
+# after upload_to_dynamodb.py or sync_catalog.py.
+#
+# Partition key Cuisine, sort key Slot. Slot 0 of each cuisine holds SlotCount
+# and slots 1..SlotCount hold one restaurant each with its name, address and
+# rating copied in, so LF2 can pick random slot numbers and fetch them all in
+# a single BatchGetItem.
+INDEX_TABLE = os.environ.get('RECOMMENDATION_INDEX_TABLE', 'RecommendationIndex')
+
+def ensure_table():
+    dynamodb = get_dynamodb()
+    try:
+        dynamodb.meta.client.describe_table(TableName=INDEX_TABLE)
+        return
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+
+    print(f"Creating {INDEX_TABLE}...")
+    table = dynamodb.create_table(
+        TableName=INDEX_TABLE,
+        KeySchema=[
+            {'AttributeName': 'Cuisine', 'KeyType': 'HASH'},
+            {'AttributeName': 'Slot', 'KeyType': 'RANGE'}
+        ],
+        AttributeDefinitions=[
+            {'AttributeName': 'Cuisine', 'AttributeType': 'S'},
+            {'AttributeName': 'Slot', 'AttributeType': 'N'}
+        ],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    table.wait_until_exists()
+
+def group_by_cuisine(restaurants):
+    # Same cuisine as the OpenSearch documents: the first category alias
+    groups = {}
+    for r in restaurants:
+        cuisine = r['categories'][0]['alias'] if r.get('categories') else 'unknown'
+        groups.setdefault(cuisine, []).append({
+            'Business ID': r['id'],
+            'Name': r.get('name', 'Unknown'),
+            'Address': ", ".join(r.get('location', {}).get('display_address', [])),
+            'Rating': float_to_decimal(r.get('rating', 0))
+        })
+    return groups
+
+def slot_requests(groups):
+    batch = []
+    for cuisine, restaurants in groups.items():
+        # Best rated first, so a rebuild of the same data gives the same slots
+        restaurants.sort(key=lambda item: (-item['Rating'], item['Business ID']))
+        for slot, item in enumerate(restaurants, 1):
+            batch.append(put_request(dict(item, Cuisine=cuisine, Slot=slot)))
+            if len(batch) == BATCH_SIZE:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def old_slot_counts(cuisines):
+    table = get_dynamodb().Table(INDEX_TABLE)
+    counts = {}
+    for cuisine in cuisines:
+        item = table.get_item(Key={'Cuisine': cuisine, 'Slot': 0}).get('Item')
+        counts[cuisine] = int(item['SlotCount']) if item else 0
+    return counts
+
+def scan_cuisines():
+    # Cuisines from an earlier build that have no restaurants any more
+    table = get_dynamodb().Table(INDEX_TABLE)
+    kwargs = {
+        'FilterExpression': 'Slot = :zero',
+        'ProjectionExpression': 'Cuisine',
+        'ExpressionAttributeValues': {':zero': 0}
+    }
+    cuisines = set()
+    while True:
+        response = table.scan(**kwargs)
+        cuisines.update(item['Cuisine'] for item in response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return cuisines
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def build_index():
+    ensure_table()
+
+    groups = group_by_cuisine(read_restaurants())
+    previous = old_slot_counts(scan_cuisines() | set(groups))
+    print(f"Indexing {sum(len(r) for r in groups.values())} restaurants across {len(groups)} cuisines...")
+
+    # Slots first, then the counts, so LF2 never reads a slot that isn't there yet
+    stats = write_all(slot_requests(groups), INDEX_TABLE)
+    counts = [
+        put_request({'Cuisine': cuisine, 'Slot': 0, 'SlotCount': len(groups.get(cuisine, []))})
+        for cuisine in previous
+    ]
+    write_all((counts[i:i + BATCH_SIZE] for i in range(0, len(counts), BATCH_SIZE)), INDEX_TABLE)
+
+    # Drop slots past the new end of any cuisine that shrank
+    stale = [
+        {'DeleteRequest': {'Key': {'Cuisine': cuisine, 'Slot': slot}}}
+        for cuisine, old_count in previous.items()
+        for slot in range(len(groups.get(cuisine, [])) + 1, old_count + 1)
+    ]
+    write_all((stale[i:i + BATCH_SIZE] for i in range(0, len(stale), BATCH_SIZE)), INDEX_TABLE)
+
+    print(f"Success! Wrote {stats.written} slots to {INDEX_TABLE} and removed {len(stale)} stale ones ({stats.failed} failed).")
+    bump_catalog_version()
+
+if __name__ == '__main__':
+    build_index()
@@ -0,0 +1,82 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+# Checks the gazetteer's fuzzy matching against what users type: typos in
+# longer names are forgiven, but a name is never turned into a different
+# cuisine ("american" must not become mexican, "chai" must not become thai).
+# Runs against the built-in table and against a gazetteer like the one
+# build_gazetteer.py writes from a Yelp scrape.
+#
+# Usage: python check_gazetteer.py
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-functions')
+
+SCRAPED = {
+    'cuisines': {
+        'mexican': {'title': 'Mexican', 'names': ['mexican'], 'restaurants': 40},
+        'tradamerican': {'title': 'American (Traditional)', 'names': ['american traditional', 'tradamerican'], 'restaurants': 30},
+        'newamerican': {'title': 'American (New)', 'names': ['american new', 'newamerican'], 'restaurants': 20},
+        'thai': {'title': 'Thai', 'names': ['thai'], 'restaurants': 10},
+        'indpak': {'title': 'Indian', 'names': ['indian', 'indpak'], 'restaurants': 10},
+        'italian': {'title': 'Italian', 'names': ['italian'], 'restaurants': 10}
+    },
+    'locations': {'New York': {'names': ['nyc', 'manhattan']}}
+}
+
+# text -> the alias it must match, None for a miss (LF1 reprompts)
+CASES = {
+    'built-in': {
+        'american': None, 'American food': None, 'chai': None, 'thai': 'thai', 'Thai food': 'thai',
+        'itallian': 'italian', 'Indian food': 'indpak', 'mexcan': 'mexican', 'japanse': 'japanese', 'korean': None
+    },
+    'scraped': {
+        'american': None, 'American food': None, 'american new': 'newamerican', 'American (Traditional)': 'tradamerican',
+        'chai': None, 'itallian': 'italian', 'mexican': 'mexican'
+    }
+}
+
+# text -> titles LF1 offers in its reprompt
+SUGGESTIONS = {
+    'scraped': {'american': ['American (New)', 'American (Traditional)']}
+}
+
+def run(table, gazetteer_file):
+    code = (
+        "import json, sys, gazetteer\n"
+        "cases, suggestions = json.loads(sys.argv[1]), json.loads(sys.argv[2])\n"
+        "print(json.dumps([{text: gazetteer.match_cuisine(text) for text in cases},"
+        " {text: gazetteer.similar_cuisines(text) for text in suggestions}]))\n"
+    )
+    env = dict(os.environ, GAZETTEER_FILE=gazetteer_file)
+    result = subprocess.run(
+        [sys.executable, '-c', code, json.dumps(list(CASES[table])), json.dumps(list(SUGGESTIONS.get(table, {})))],
+        cwd=LAMBDA_DIR, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise Exception(f"gazetteer failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout)
+
+def main():
+    problems = []
+    with tempfile.TemporaryDirectory() as directory:
+        scraped_file = os.path.join(directory, 'gazetteer.json')
+        with open(scraped_file, 'w') as file:
+            json.dump(SCRAPED, file)
+
+        for table, gazetteer_file in (('built-in', os.path.join(directory, 'missing.json')), ('scraped', scraped_file)):
+            matches, suggestions = run(table, gazetteer_file)
+            for text, expected in CASES[table].items():
+                if matches[text] != expected:
+                    problems.append(f"{table}: {text!r} matched {matches[text]!r}, expected {expected!r}")
+            for text, expected in SUGGESTIONS.get(table, {}).items():
+                if suggestions[text] != expected:
+                    problems.append(f"{table}: {text!r} suggested {suggestions[text]!r}, expected {expected!r}")
+
+    print('\n'.join(problems) or 'ok')
+    sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import os
+import subprocess
+import sys
+
+# Cold start check for the Lambda handlers. Imports each one in a fresh
+# interpreter with -X importtime and fails if the import takes longer than the
+# budget or pulls in a module that should only load on first use.
+#
+# Usage: python check_import_time.py [LF0 LF1 LF2]
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-functions')
+IMPORT_BUDGET_MS = float(os.environ.get('IMPORT_BUDGET_MS', '150'))
+RUNS = 3
+
+# Only built when a handler first needs them
+LAZY_MODULES = ['boto3', 'botocore', 'urllib3']
+
+def measure(module):
+    # Best of a few runs, the first one also pays for writing the .pyc files
+    best = None
+    for _ in range(RUNS):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f"import sys, {module}; print(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"],
+            cwd=LAMBDA_DIR, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            raise Exception(f"importing {module} failed:\n{result.stderr[-2000:]}")
+
+        # Lines look like "import time:  self [us] | cumulative | name"
+        cumulative_us = None
+        for line in result.stderr.splitlines():
+            parts = line.split('|')
+            if len(parts) == 3 and parts[2].strip() == module and not parts[2].startswith('  '):
+                cumulative_us = int(parts[1])
+        ms = cumulative_us / 1000
+        loaded = result.stdout.split()
+        if best is None or ms < best[0]:
+            best = (ms, loaded)
+    return best
+
+def main():
+    failed = False
+    for module in sys.argv[1:] or ['LF0', 'LF1', 'LF2']:
+        ms, loaded = measure(module)
+        problems = []
+        if ms > IMPORT_BUDGET_MS:
+            problems.append(f"over the {IMPORT_BUDGET_MS:.0f} ms budget")
+        if loaded:
+            problems.append(f"imports {', '.join(loaded)} at load")
+        print(f"{module:<6} {ms:8.1f} ms  {'; '.join(problems) or 'ok'}")
+        failed = failed or bool(problems)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
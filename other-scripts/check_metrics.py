@@ -0,0 +1,53 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-functions'))
+import metrics
+
+# Checks that metrics.instrument times failed AWS calls without getting in the
+# way of the error. A connection error is injected under an instrumented
+# client: the caller must see the EndpointConnectionError itself, and the call
+# must be recorded and counted.
+#
+# Usage: python check_metrics.py
+
+def failing_client():
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import EndpointConnectionError
+
+    client = boto3.session.Session(aws_access_key_id='check', aws_secret_access_key='check').client(
+        'sqs', region_name='us-east-1', config=Config(retries={'total_max_attempts': 1})
+    )
+
+    def refuse(request, **kwargs):
+        raise EndpointConnectionError(endpoint_url=request.url)
+
+    client.meta.events.register('before-send.*.*', refuse)
+    return metrics.instrument(client)
+
+def main():
+    from botocore.exceptions import EndpointConnectionError
+
+    problems = []
+    try:
+        failing_client().list_queues()
+        problems.append("the call didn't fail")
+    except EndpointConnectionError:
+        pass
+    except Exception as e:
+        problems.append(f"the caller got {type(e).__name__}: {e} instead of EndpointConnectionError")
+
+    with metrics._lock:
+        timings = dict(metrics._timings)
+        counts = dict(metrics._counts)
+    if len(timings.get('sqs.ListQueues', [])) != 1:
+        problems.append(f"the failed call wasn't timed: {timings}")
+    if counts.get('sqs.ListQueues.Errors') != 1:
+        problems.append(f"the failed call wasn't counted: {counts}")
+
+    print('; '.join(problems) or 'ok')
+    sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+    main()
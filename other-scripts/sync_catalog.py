@@ -0,0 +1,95 @@
+import json
+import os
+from dotenv import load_dotenv
+from yelp_data import read_restaurants, record_hash, is_complete
+from upload_to_dynamodb import build_item, put_request, delete_request, write_all, get_dynamodb, bump_catalog_version, TABLE_NAME, BATCH_SIZE
+from upload_to_opensearch import client, index_name, build_document, bulk_results
+
+load_dotenv()
+
+# Hash of every restaurant as of the last successful sync
+STATE_FILE = os.environ.get('SYNC_STATE_FILE', 'sync_state.json')
+
+def load_state():
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE, 'r') as file:
+            return json.load(file)
+
+    # No local state, rebuild it from the hashes stored with each item
+    print(f"No {STATE_FILE}, reading record hashes from DynamoDB...")
+    table = get_dynamodb().Table(TABLE_NAME)
+    state = {}
+    kwargs = {
+        'ProjectionExpression': '#id, recordHash',
+        'ExpressionAttributeNames': {'#id': 'Business ID'}
+    }
+    while True:
+        response = table.scan(**kwargs)
+        for item in response['Items']:
+            state[item['Business ID']] = item.get('recordHash')
+        if 'LastEvaluatedKey' not in response:
+            return state
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def save_state(state):
+    with open(STATE_FILE + '.tmp', 'w') as file:
+        json.dump(state, file)
+    os.replace(STATE_FILE + '.tmp', STATE_FILE)
+
+def chunked(requests, size):
+    for i in range(0, len(requests), size):
+        yield requests[i:i + size]
+
+def sync_catalog():
+    known = load_state()
+
+    current = {}
+    changed = []
+    for r in read_restaurants():
+        current[r['id']] = record_hash(r)
+        if known.get(r['id']) != current[r['id']]:
+            changed.append(r)
+
+    # Only a finished scrape can tell us a restaurant is really gone
+    if is_complete():
+        removed = [rid for rid in known if rid not in current]
+    else:
+        removed = []
+        print("The scrape didn't finish, so nothing will be deleted this time.")
+
+    print(f"{len(current)} restaurants scraped: {len(changed)} new or changed, {len(removed)} removed.")
+    if not changed and not removed:
+        print("Nothing to sync.")
+        return
+
+    # DynamoDB
+    requests = [put_request(build_item(r)) for r in changed] + [delete_request(rid) for rid in removed]
+    stats = write_all(chunked(requests, BATCH_SIZE))
+    print(f"DynamoDB: {stats.written} writes, {stats.throttles} throttles, {stats.failed} failed.")
+
+    # OpenSearch
+    actions = [{'_index': index_name, '_id': r['id'], '_source': build_document(r)} for r in changed]
+    actions += [{'_op_type': 'delete', '_index': index_name, '_id': rid} for rid in removed]
+    failures = []
+    for ok, info in bulk_results(actions):
+        action, result = next(iter(info.items()))
+        # Deleting something that was never indexed is fine
+        if not ok and not (action == 'delete' and result.get('status') == 404):
+            failures.append(result)
+    client.indices.refresh(index=index_name)
+    print(f"OpenSearch: {len(actions) - len(failures)} updates, {len(failures)} failed.")
+    for result in failures:
+        print(f"  {result.get('_id')}: {result.get('status')} {result.get('error')}")
+    bump_catalog_version()
+
+    # Keep the old state on any failure so the next sync tries again
+    if stats.failed or failures:
+        print("Some writes failed, sync state not updated.")
+        return
+
+    state = current if is_complete() else dict(known, **current)
+    save_state(state)
+    print(f"Success! Sync state saved to {STATE_FILE}.")
+
+if __name__ == '__main__':
+    sync_catalog()
@@ -1,15 +1,42 @@
 import boto3
-import json
 import datetime
 import os
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from decimal import Decimal
+from botocore.exceptions import ClientError
 from dotenv import load_dotenv
+from yelp_data import read_restaurants, record_hash
+
+# The snapshot format lives with LF2, which reads it
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-functions'))
+from catalog_snapshot import write_snapshot
 
 load_dotenv()
 
-# Initialize the DynamoDB resource
-dynamodb = boto3.resource('dynamodb', region_name=os.environ.get('AWS_REGION', 'us-east-1'))
-table = dynamodb.Table(os.environ.get('DYNAMODB_TABLE', 'yelp-restaurants'))
+AWS_REGION = os.environ.get('AWS_REGION', 'us-east-1')
+TABLE_NAME = os.environ.get('DYNAMODB_TABLE', 'yelp-restaurants')
+# Holds the catalog version LF2 keys its cached candidate sets on
+CACHE_TABLE = os.environ.get('CANDIDATE_CACHE_TABLE', 'RecommendationCache')
+# Rewritten at every version bump; ship it to LF2 as a layer or next to the code
+SNAPSHOT_FILE = os.environ.get('CATALOG_SNAPSHOT', 'catalog.snapshot')
+
+# Parallel loading
+WRITE_THREADS = int(os.environ.get('DYNAMODB_WRITE_THREADS', '4'))
+WRITE_RATE = float(os.environ.get('DYNAMODB_WRITE_RATE', '0'))  # items/sec, 0 = no limit
+MAX_RETRIES = 8
+INITIAL_BACKOFF = 0.05  # seconds
+BATCH_SIZE = 25  # BatchWriteItem limit
+
+# Boto3 resources aren't thread safe, so each writer thread gets its own
+_local = threading.local()
+
+def get_dynamodb():
+    if not hasattr(_local, 'dynamodb'):
+        _local.dynamodb = boto3.session.Session().resource('dynamodb', region_name=AWS_REGION)
+    return _local.dynamodb
 
 # Helper function to convert floats to Decimals
 def float_to_decimal(data):
@@ -21,42 +48,173 @@ def float_to_decimal(data):
         return [float_to_decimal(v) for v in data]
     return data
 
-def upload_data():
-    with open('raw_yelp_data.json', 'r') as file:
-        restaurants = json.load(file)
-        
-    print(f"Loaded {len(restaurants)} restaurants. Starting upload...")
+def build_item(r):
+    # Format the address as a single string
+    address = ", ".join(r.get('location', {}).get('display_address', []))
     
-    count = 0
-    # Process and upload each restaurant
+    return {
+        'Business ID': r['id'], # Partition key
+        'Name': r.get('name', 'Unknown'),
+        'Address': address,
+        'Coordinates': float_to_decimal(r.get('coordinates', {})),
+        'Number of Reviews': r.get('review_count', 0),
+        'Rating': float_to_decimal(r.get('rating', 0)),
+        'Zip Code': r.get('location', {}).get('zip_code', 'Unknown'),
+        'insertedAtTimestamp': str(datetime.datetime.now()),
+        # lets sync_catalog.py tell whether the record changed
+        'recordHash': record_hash(r)
+    }
+
+class RateLimiter:
+    # Token bucket shared by all writer threads
+    def __init__(self, rate):
+        self.rate = rate
+        # big enough for a full batch even at very low rates
+        self.capacity = max(rate, BATCH_SIZE)
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+class UploadStats:
+    def __init__(self):
+        self.written = 0
+        self.failed = 0
+        self.retries = 0
+        self.throttles = 0
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.lock = threading.Lock()
+
+    def add(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+            now = time.monotonic()
+            if now - self.last_report >= 5:
+                self.last_report = now
+                print(f"Uploaded {self.written} restaurants ({self.rate():.0f} rows/sec)...")
+
+    def rate(self):
+        return self.written / max(time.monotonic() - self.started, 1e-9)
+
+def put_request(item):
+    return {'PutRequest': {'Item': item}}
+
+def delete_request(business_id):
+    return {'DeleteRequest': {'Key': {'Business ID': business_id}}}
+
+def write_batch(requests, limiter, stats, table_name=TABLE_NAME):
+    dynamodb = get_dynamodb()
+
+    for attempt in range(MAX_RETRIES):
+        limiter.acquire(len(requests))
+        try:
+            response = dynamodb.batch_write_item(RequestItems={table_name: requests})
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('ProvisionedThroughputExceededException', 'ThrottlingException'):
+                raise
+            stats.add(throttles=1, retries=1)
+        else:
+            unprocessed = response.get('UnprocessedItems', {}).get(table_name, [])
+            stats.add(written=len(requests) - len(unprocessed))
+            if not unprocessed:
+                return
+            # DynamoDB only took part of the batch, back off and resend the rest
+            requests = unprocessed
+            stats.add(retries=1)
+        time.sleep(INITIAL_BACKOFF * (2 ** attempt))
+
+    print(f"Giving up on {len(requests)} items after {MAX_RETRIES} attempts")
+    stats.add(failed=len(requests))
+
+def generate_batches(restaurants):
+    batch = []
     for r in restaurants:
         try:
-            # Format the address as a single string
-            address = ", ".join(r.get('location', {}).get('display_address', []))
-            
-            item = {
-                'Business ID': r['id'], # Partition key
-                'Name': r.get('name', 'Unknown'),
-                'Address': address,
-                'Coordinates': float_to_decimal(r.get('coordinates', {})),
-                'Number of Reviews': r.get('review_count', 0),
-                'Rating': float_to_decimal(r.get('rating', 0)),
-                'Zip Code': r.get('location', {}).get('zip_code', 'Unknown'),
-                'insertedAtTimestamp': str(datetime.datetime.now())
-            }
-            
-            # Upload to DynamoDB
-            table.put_item(Item=item)
-            count += 1
-            
-            # Print progress
-            if count % 100 == 0:
-                print(f"Uploaded {count} restaurants...")
-                
+            batch.append(put_request(build_item(r)))
         except Exception as e:
-            print(f"Error uploading {r.get('id')}: {str(e)}")
+            print(f"Error preparing {r.get('id')}: {str(e)}")
+            continue
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def write_all(batches, table_name=TABLE_NAME):
+    limiter = RateLimiter(WRITE_RATE)
+    stats = UploadStats()
+
+    def finish(future):
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Error uploading batch: {str(e)}")
+            stats.add(failed=len(in_flight[future]))
+
+    # Only a few batches are held in memory at a time, however big the file is
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=WRITE_THREADS) as pool:
+        for batch in batches:
+            if len(in_flight) >= WRITE_THREADS * 2:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future)
+                    del in_flight[future]
+            in_flight[pool.submit(write_batch, batch, limiter, stats, table_name)] = batch
+        for future in list(in_flight):
+            finish(future)
+    return stats
+
+def bump_catalog_version():
+    # LF2 drops its cached cuisine candidate sets when this changes, and
+    # stops using a snapshot built for an older version
+    version = None
+    try:
+        response = get_dynamodb().Table(CACHE_TABLE).update_item(
+            Key={'CacheKey': 'catalog-version'},
+            UpdateExpression='ADD Version :one',
+            ExpressionAttributeValues={':one': 1},
+            ReturnValues='UPDATED_NEW'
+        )
+        version = int(response['Attributes']['Version'])
+        print(f"Catalog version is now {version}.")
+    except Exception as e:
+        print(f"Couldn't bump the catalog version in {CACHE_TABLE}: {str(e)}")
+    write_catalog_snapshot(version)
+    return version
+
+def write_catalog_snapshot(version):
+    if not SNAPSHOT_FILE:
+        return
+    try:
+        rows = write_snapshot(read_restaurants(follow=False), SNAPSHOT_FILE, version)
+        print(f"Wrote {rows} restaurants to {SNAPSHOT_FILE} (catalog version {version}).")
+    except Exception as e:
+        print(f"Couldn't write the catalog snapshot: {str(e)}")
+
+def upload_data():
+    print("Starting upload...")
+
+    stats = write_all(generate_batches(read_restaurants()))
             
-    print(f"Success! Uploaded a total of {count} restaurants to DynamoDB.")
+    print(f"Success! Uploaded a total of {stats.written} restaurants to DynamoDB ({stats.rate():.0f} rows/sec).")
+    print(f"Throttled {stats.throttles} times, retried {stats.retries} batches, {stats.failed} items failed.")
+    bump_catalog_version()
 
 if __name__ == '__main__':
-    upload_data()
\ No newline at end of file
+    upload_data()
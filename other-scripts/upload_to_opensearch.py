@@ -1,7 +1,8 @@
-from opensearchpy import OpenSearch, RequestsHttpConnection
+from opensearchpy import OpenSearch, RequestsHttpConnection, helpers
 from dotenv import load_dotenv
-import json
 import os
+from yelp_data import read_restaurants
+from upload_to_dynamodb import bump_catalog_version
 
 load_dotenv()
 
@@ -9,6 +10,24 @@ load_dotenv()
 host = os.environ['OPENSEARCH_HOST']
 region = os.environ.get('AWS_REGION', 'us-east-1')
 auth = (os.environ['OPENSEARCH_USERNAME'], os.environ['OPENSEARCH_PASSWORD'])
+index_name = os.environ.get('OPENSEARCH_INDEX', 'restaurants')
+
+# Bulk loading
+CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', '500'))
+THREAD_COUNT = int(os.environ.get('BULK_THREADS', '4'))
+
+# Cuisine and RestaurantID are exact values, so keep them out of text analysis
+INDEX_BODY = {
+    'mappings': {
+        'properties': {
+            'RestaurantID': {'type': 'keyword'},
+            'Cuisine': {'type': 'keyword'},
+            'Rating': {'type': 'float'},
+            'Number of Reviews': {'type': 'integer'},
+            'type': {'type': 'keyword'}
+        }
+    }
+}
 
 # Create the OpenSearch client
 client = OpenSearch(
@@ -16,45 +35,98 @@ client = OpenSearch(
     http_auth = auth,
     use_ssl = True,
     verify_certs = True,
-    connection_class = RequestsHttpConnection
+    connection_class = RequestsHttpConnection,
+    pool_maxsize = THREAD_COUNT
 )
 
-def upload_to_opensearch():
-    with open('raw_yelp_data.json', 'r') as file:
-        restaurants = json.load(file)
-        
-    print(f"Loaded {len(restaurants)} restaurants. Starting upload to OpenSearch...")
-    
+def build_document(r):
+    document = {
+        'RestaurantID': r['id'],
+        'Cuisine': r['categories'][0]['alias'] if r.get('categories') else 'unknown',
+        # used by LF2 to weight its random picks
+        'Rating': r.get('rating', 0),
+        'Number of Reviews': r.get('review_count', 0)
+    }
+    document['type'] = 'Restaurant'
+    return document
+
+def generate_actions(restaurants):
+    for r in restaurants:
+        yield {
+            '_index': index_name,
+            '_id': r['id'],
+            '_source': build_document(r)
+        }
+
+def prepare_index():
     # create the restaurants index
-    index_name = 'restaurants'
     if not client.indices.exists(index=index_name):
-        client.indices.create(index=index_name)
+        client.indices.create(index=index_name, body=INDEX_BODY)
         print(f"Created index: {index_name}")
+    else:
+        mapping = client.indices.get_mapping(index=index_name)[index_name]['mappings']
+        if mapping.get('properties', {}).get('Cuisine', {}).get('type') != 'keyword':
+            print(f"Warning: {index_name} was created without the keyword mapping, delete it to pick it up.")
+
+    # Remember the live settings so we can put them back after the load
+    settings = client.indices.get_settings(index=index_name)[index_name]['settings']['index']
+    original = {
+        'refresh_interval': settings.get('refresh_interval', '1s'),
+        'number_of_replicas': settings.get('number_of_replicas', '1')
+    }
+
+    # No refreshes and no replicas while we write
+    client.indices.put_settings(index=index_name, body={'index': {'refresh_interval': '-1', 'number_of_replicas': 0}})
+    return original
+
+def restore_index(original):
+    client.indices.put_settings(index=index_name, body={'index': original})
+    client.indices.refresh(index=index_name)
+
+def bulk_results(actions):
+    # Several writer threads, or one streaming writer that retries 429s
+    if THREAD_COUNT > 1:
+        return helpers.parallel_bulk(
+            client, actions,
+            thread_count=THREAD_COUNT,
+            chunk_size=CHUNK_SIZE,
+            raise_on_error=False,
+            raise_on_exception=False
+        )
+    return helpers.streaming_bulk(
+        client, actions,
+        chunk_size=CHUNK_SIZE,
+        max_retries=3,
+        raise_on_error=False,
+        raise_on_exception=False
+    )
+
+def upload_to_opensearch():
+    print("Starting bulk upload to OpenSearch...")
+
+    original = prepare_index()
 
     count = 0
-    for r in restaurants:
-        try:
-            document = {
-                'RestaurantID': r['id'],
-                'Cuisine': r['categories'][0]['alias'] if r.get('categories') else 'unknown' 
-            }
-            document['type'] = 'Restaurant'
-            
-            # Upload the document
-            response = client.index(
-                index=index_name,
-                body=document,
-                id=r['id'],
-                refresh=True
-            )
-            count += 1
-            if count % 100 == 0:
-                print(f"Uploaded {count} records to OpenSearch...")
-                
-        except Exception as e:
-            print(f"Error uploading {r['id']}: {e}")
-            
+    failures = []
+    try:
+        for ok, info in bulk_results(generate_actions(read_restaurants())):
+            if ok:
+                count += 1
+                if count % 100 == 0:
+                    print(f"Uploaded {count} records to OpenSearch...")
+            else:
+                failures.append(info)
+    finally:
+        # Put refresh and replicas back and make everything searchable at once
+        restore_index(original)
+
     print(f"Success! Uploaded {count} records to OpenSearch.")
+    bump_catalog_version()
+    if failures:
+        print(f"{len(failures)} documents failed:")
+        for info in failures:
+            action, result = next(iter(info.items()))
+            print(f"  {result.get('_id')}: {result.get('status')} {result.get('error')}")
 
 if __name__ == '__main__':
-    upload_to_opensearch()
\ No newline at end of file
+    upload_to_opensearch()
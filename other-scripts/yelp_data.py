@@ -0,0 +1,104 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+
+# Raw Yelp data is newline-delimited JSON, one business per line. A name
+# ending in .gz is gzip compressed.
+DATA_FILE = os.environ.get('YELP_DATA_FILE', 'raw_yelp_data.jsonl')
+# Keep reading while the scraper is still writing (plain files only)
+FOLLOW = os.environ.get('YELP_DATA_FOLLOW', '').lower() in ('1', 'true', 'yes')
+
+def open_data(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+def done_marker(path):
+    return path + '.done'
+
+def checkpoint_file(path):
+    return path + '.checkpoint'
+
+def is_complete(path=DATA_FILE):
+    # The done marker says whether every page made it into the file
+    if not os.path.exists(done_marker(path)):
+        return False
+    with open(done_marker(path), 'r') as file:
+        return file.read().strip() == 'complete'
+
+def record_hash(r):
+    # Only the fields the loaders actually store, so Yelp reshuffling
+    # unrelated fields doesn't count as a change
+    normalized = {
+        'id': r['id'],
+        'name': r.get('name'),
+        'address': r.get('location', {}).get('display_address', []),
+        'zip_code': r.get('location', {}).get('zip_code'),
+        'coordinates': r.get('coordinates', {}),
+        'rating': r.get('rating'),
+        'review_count': r.get('review_count'),
+        'cuisine': r['categories'][0]['alias'] if r.get('categories') else None
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+class DataWriter:
+    # Appends records as they are fetched and marks the file complete on close.
+    # With append=True an interrupted scrape is continued instead of replaced.
+    def __init__(self, path=DATA_FILE, append=False):
+        self.path = path
+        if os.path.exists(done_marker(path)):
+            os.remove(done_marker(path))
+        self.file = open_data(path, 'a' if append else 'w')
+        self.count = 0
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self, complete=True):
+        self.file.close()
+        with open(done_marker(self.path), 'w') as marker:
+            marker.write('complete' if complete else 'partial')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(complete=exc_type is None)
+
+def read_restaurants(path=DATA_FILE, follow=FOLLOW):
+    with open_data(path, 'r') as file:
+        # Old scrapes are a single JSON array
+        first = file.read(1)
+        if first == '[':
+            file.seek(0)
+            yield from json.load(file)
+            return
+        file.seek(0)
+
+        # Without follow we stop at the first end of file, with it we wait
+        # for the scraper's done marker and then read what's left
+        finished = not follow
+        pending = ''
+        while True:
+            line = file.readline()
+            if line:
+                pending += line
+                if pending.endswith('\n'):
+                    if pending.strip():
+                        yield json.loads(pending)
+                    pending = ''
+                continue
+            if not finished:
+                finished = os.path.exists(done_marker(path))
+                if not finished:
+                    time.sleep(0.5)
+                continue
+            if pending.strip():
+                yield json.loads(pending)
+            return
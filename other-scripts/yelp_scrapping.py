@@ -1,8 +1,10 @@
-import requests
+import aiohttp
+import asyncio
 import json
 import time
 import os
 from dotenv import load_dotenv
+from yelp_data import DataWriter, DATA_FILE, checkpoint_file, read_restaurants
 
 load_dotenv()
 
@@ -13,55 +15,180 @@ ENDPOINT = 'https://api.yelp.com/v3/businesses/search'
 MAX_RETRIES = 5
 INITIAL_BACKOFF = 1  # seconds
 
+# Yelp's limits: requests per second and requests per day
+YELP_QPS = float(os.environ.get('YELP_QPS', '5'))
+YELP_DAILY_LIMIT = int(os.environ.get('YELP_DAILY_LIMIT', '5000'))
+MAX_CONCURRENCY = int(os.environ.get('YELP_CONCURRENCY', '10'))
+# Pick up an interrupted scrape where it stopped
+RESUME = os.environ.get('YELP_RESUME', '').lower() in ('1', 'true', 'yes')
+
 # required cuisines and location
 cuisines = ['chinese', 'italian', 'japanese', 'mexican', 'indian', 'thai']
-location = 'Manhattan'
+locations = [l.strip() for l in os.environ.get('YELP_LOCATIONS', 'Manhattan').split(',') if l.strip()]
+
+# Yelp only returns 50 at a time
+PAGE_SIZE = 50
+MAX_RESULTS = 200
+
+class RateLimiter:
+    # Token bucket shared by every request, plus a hard cap for the day
+    def __init__(self, rate, daily_limit):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.remaining = daily_limit
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            if self.remaining <= 0:
+                raise Exception("Daily Yelp request quota used up")
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.remaining -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Checkpoint:
+    # Pages already saved to the data file, one JSON line per page
+    def __init__(self, path, resume):
+        self.path = path
+        self.pages = {}
+        if resume and os.path.exists(path):
+            with open(path, 'r') as file:
+                for line in file:
+                    if line.strip():
+                        page = json.loads(line)
+                        self.pages[(page['cuisine'], page['location'], page['offset'])] = page
+        self.file = open(path, 'a' if resume else 'w')
 
-all_restaurants = {}
+    def get(self, cuisine, location, offset):
+        return self.pages.get((cuisine, location, offset))
 
-for cuisine in cuisines:
-    print(f"Fetching {cuisine} restaurants...")
-    
-    # Yelp only returns 50 at a time
-    for offset in range(0, 200, 50):
+    def mark(self, cuisine, location, offset, count, total):
+        page = {'cuisine': cuisine, 'location': location, 'offset': offset, 'count': count, 'total': total}
+        self.pages[(cuisine, location, offset)] = page
+        self.file.write(json.dumps(page) + '\n')
+        self.file.flush()
+        return page
+
+    def close(self, finished):
+        self.file.close()
+        # A finished scrape starts from scratch next time
+        if finished:
+            os.remove(self.path)
+
+class Scraper:
+    def __init__(self, session, writer, checkpoint, seen_ids):
+        self.session = session
+        self.writer = writer
+        self.checkpoint = checkpoint
+        self.limiter = RateLimiter(YELP_QPS, YELP_DAILY_LIMIT)
+        self.slots = asyncio.Semaphore(MAX_CONCURRENCY)
+        # IDs already written, so each business appears once in the output
+        self.seen_ids = seen_ids
+        self.failed = 0
+
+    async def fetch_page(self, cuisine, location, offset):
         params = {
             'term': f'{cuisine} restaurants',
             'location': location,
-            'limit': 50,
+            'limit': PAGE_SIZE,
             'offset': offset
         }
         
-        for attempt in range(MAX_RETRIES):
-            response = requests.get(ENDPOINT, headers=HEADERS, params=params)
-            
-            if response.status_code == 200:
-                data = response.json()
-                businesses = data.get('businesses', [])
-                
-                for biz in businesses:
-                    biz_id = biz['id']
-                    if biz_id not in all_restaurants:
-                        all_restaurants[biz_id] = biz
-                break  # success, move on to next request
-            elif response.status_code == 429:
-                # Rate limited — use Retry-After header if available, otherwise exponential backoff
-                retry_after = response.headers.get('Retry-After')
-                if retry_after:
-                    wait = int(retry_after)
-                else:
-                    wait = INITIAL_BACKOFF * (2 ** attempt)
-                print(f"Rate limited on {cuisine} offset {offset}. Retrying in {wait}s (attempt {attempt + 1}/{MAX_RETRIES})...")
-                time.sleep(wait)
-            else:
-                print(f"Error fetching {cuisine} at offset {offset}: {response.status_code}")
-                break  # non-retryable error
-        else:
-            print(f"Failed to fetch {cuisine} at offset {offset} after {MAX_RETRIES} retries.")
-
-print(f"Total unique restaurants collected: {len(all_restaurants)}")
-
-# Save the raw data to a local JSON file to use in DynamoDB
-with open('raw_yelp_data.json', 'w') as f:
-    json.dump(list(all_restaurants.values()), f, indent=4)
-    
-print("Data saved to raw_yelp_data.json!")
\ No newline at end of file
+        async with self.slots:
+            for attempt in range(MAX_RETRIES):
+                await self.limiter.acquire()
+                async with self.session.get(ENDPOINT, params=params) as response:
+                    if response.status == 200:
+                        return await response.json()
+                    elif response.status == 429:
+                        # Rate limited — use Retry-After header if available, otherwise exponential backoff
+                        retry_after = response.headers.get('Retry-After')
+                        if retry_after:
+                            wait = int(retry_after)
+                        else:
+                            wait = INITIAL_BACKOFF * (2 ** attempt)
+                        print(f"Rate limited on {cuisine} offset {offset}. Retrying in {wait}s (attempt {attempt + 1}/{MAX_RETRIES})...")
+                    else:
+                        print(f"Error fetching {cuisine} at offset {offset}: {response.status}")
+                        return None  # non-retryable error
+                await asyncio.sleep(wait)
+
+        print(f"Failed to fetch {cuisine} at offset {offset} after {MAX_RETRIES} retries.")
+        return None
+
+    async def page(self, cuisine, location, offset):
+        page = self.checkpoint.get(cuisine, location, offset)
+        if page:
+            return page
+
+        data = await self.fetch_page(cuisine, location, offset)
+        if data is None:
+            self.failed += 1
+            return None
+        # The page is in the data file before it's in the checkpoint
+        count = self.save(data)
+        return self.checkpoint.mark(cuisine, location, offset, count, data.get('total', MAX_RESULTS))
+
+    def save(self, data):
+        businesses = data.get('businesses', [])
+        for biz in businesses:
+            biz_id = biz['id']
+            if biz_id not in self.seen_ids:
+                self.seen_ids.add(biz_id)
+                self.writer.write(biz)
+        self.writer.flush()
+        return len(businesses)
+
+    async def scrape(self, cuisine, location):
+        print(f"Fetching {cuisine} restaurants in {location}...")
+
+        # The first page tells us how many results there are, the rest of the
+        # pages are then fetched at the same time
+        first = await self.page(cuisine, location, 0)
+        if not first or first['count'] < PAGE_SIZE:
+            return
+
+        total = min(first['total'], MAX_RESULTS)
+        offsets = range(PAGE_SIZE, total, PAGE_SIZE)
+        await asyncio.gather(*(self.page(cuisine, location, o) for o in offsets))
+
+async def main():
+    resume = RESUME and os.path.exists(DATA_FILE)
+    seen_ids = {r['id'] for r in read_restaurants(DATA_FILE, follow=False)} if resume else set()
+    if resume:
+        print(f"Resuming scrape with {len(seen_ids)} restaurants already saved...")
+    checkpoint = Checkpoint(checkpoint_file(DATA_FILE), resume)
+
+    # One pooled session for every request
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENCY)
+    async with aiohttp.ClientSession(headers=HEADERS, connector=connector) as session:
+        # Each business is written out as soon as it's fetched, so the loaders
+        # can start reading before we finish
+        writer = DataWriter(DATA_FILE, append=resume)
+        scraper = Scraper(session, writer, checkpoint, seen_ids)
+        results = await asyncio.gather(
+            *(scraper.scrape(cuisine, location) for cuisine in cuisines for location in locations),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Error: {result}")
+                scraper.failed += 1
+        writer.close(complete=scraper.failed == 0)
+
+    checkpoint.close(finished=scraper.failed == 0)
+    if scraper.failed:
+        print(f"{scraper.failed} requests failed, run again with YELP_RESUME=1 to finish.")
+
+    print(f"Total unique restaurants collected: {len(scraper.seen_ids)}")
+    print(f"Data saved to {DATA_FILE}!")
+
+if __name__ == '__main__':
+    asyncio.run(main())